@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+import argparse
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+## BENCHMARKS
+#
+# Times the project's own scenarios, each in a fresh interpreter, so
+# one scenario's imports and caches don't affect another:
+#
+#     python benchmark.py --output results.json
+#     python benchmark.py --baseline baseline.json --tolerance 0.1
+#
+# Every scenario reports its wall time (best of --repeat runs, building
+# included), simulated steps per second and the peak memory allocated
+# by one run. A warm-up run first does the scenario's imports, like
+# matplotlib through test.py or SciPy on first use, so neither time nor
+# memory depends on them, or on --repeat. With
+# --baseline, every metric is compared to a stored result and the exit
+# status is 1 if any got worse by more than the tolerance.
+#
+#     python benchmark.py --import-budget 0.5
+#
+# only checks that importing energyoptinator takes less than the budget
+# in seconds and loads neither matplotlib nor SciPy, which the core
+# imports on first use, so sweep workers and short scripts start fast.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def offgrid_house():
+    """ test.offgrid_house_sim() without the plots: 87600 steps of four
+    grids with two CHP boilers, a battery and an accumulator.
+    """
+    import test
+    s = test.offgrid_house()
+    s.run(87600)
+    return 87600
+
+def demo1():
+    """ svenska_schabloner.demo1() without the plots: 8760 calls of
+    Simulation.step().
+    """
+    import svenska_schabloner as se
+    se.demo1_sim()
+    return 8760
+
+def solar_sweep():
+    """ The solar area sweep of house-solar-optimizer.plot_heatfactor(),
+    run in this process.
+    """
+    spec = importlib.util.spec_from_file_location('house_solar_optimizer', os.path.join(HERE, 'house-solar-optimizer.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    from sweep import Sweep
+    atemp = 150
+    sweep = Sweep( module.build
+                 , { 'solar_area': range(int(atemp/5), atemp) }
+                 , { 'heatfactor': module.max_heatfactor }
+                 , profiles=module.profiles(atemp)
+                 , steps=12
+                 , processes=1 )
+    sweep.run()
+    return 12*len(sweep.results)
+
+SCENARIOS = { 'offgrid_house': offgrid_house
+            , 'demo1': demo1
+            , 'solar_sweep': solar_sweep
+            }
+
+# Metrics where a higher value is better, all others should go down.
+HIGHER_IS_BETTER = ('steps_per_second',)
+
+def measure(name, repeat):
+    """ Runs one scenario in this process, once to warm up, repeat
+    times timed and once more for its memory, and returns its metrics.
+    The profile cache is cleared before every run, so every run builds
+    its profiles.
+    """
+    from cache import profile_cache
+    profile_cache.clear()
+    SCENARIOS[name]()
+    times = []
+    for _ in range(repeat):
+        profile_cache.clear()
+        start = time.perf_counter()
+        steps = SCENARIOS[name]()
+        times.append(time.perf_counter() - start)
+    wall = min(times)
+    return { 'wall_time': wall
+           , 'steps': steps
+           , 'steps_per_second': steps/wall
+           , 'peak_memory': _peak_memory(SCENARIOS[name])
+           }
+
+def _peak_memory(scenario):
+    """ Runs scenario and returns the peak memory it allocated in
+    bytes, traced by tracemalloc, which numpy reports its arrays to.
+    Tracing slows the run down, so it isn't timed.
+    """
+    from cache import profile_cache
+    profile_cache.clear()
+    tracemalloc.start()
+    try:
+        scenario()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def _child(arguments):
+    """ Runs this script with arguments in a fresh interpreter and
+    returns the JSON it prints. The disk tier of the profile cache and
+    the result cache are disabled, so results don't depend on earlier
+    runs.
+    """
+    env = { name: value for name, value in os.environ.items()
+            if name not in ('ENERGYOPTINATOR_CACHE', 'ENERGYOPTINATOR_RESULTS') }
+    env.setdefault('MPLBACKEND', 'Agg')
+    output = subprocess.run( [sys.executable, os.path.abspath(__file__), *arguments]
+                           , cwd=HERE, env=env, check=True, capture_output=True, text=True ).stdout
+    return json.loads(output.splitlines()[-1])
+
+def import_time(repeat):
+    """ Returns the best time of importing energyoptinator in a fresh
+    interpreter, in seconds.
+    """
+    return min(_child(['--import-time'])['import_time'] for _ in range(repeat))
+
+# Modules the core must not import, see check_import()
+HEAVY = ('matplotlib', 'scipy')
+
+def check_import(budget, repeat):
+    """ Checks that importing energyoptinator in a fresh interpreter
+    takes less than budget seconds, best of repeat tries, and loads
+    none of the HEAVY modules. Returns 0 if so and 1 otherwise.
+    """
+    results = [ _child(['--import-time']) for _ in range(repeat) ]
+    elapsed = min(result['import_time'] for result in results)
+    heavy = results[0]['heavy']
+    print(f"import energyoptinator: {elapsed*1000:.0f} ms, budget {budget*1000:.0f} ms")
+    if heavy:
+        print(f"FAIL importing energyoptinator loads {', '.join(heavy)}")
+    if elapsed > budget:
+        print("FAIL import time over budget")
+    return 1 if heavy or elapsed > budget else 0
+
+def run(names, repeat):
+    """ Runs the named scenarios, each in a fresh interpreter, and
+    returns a dictionary of the results.
+    """
+    results = { 'python': sys.version.split()[0]
+              , 'import_time': import_time(repeat)
+              , 'scenarios': {}
+              }
+    for name in names:
+        results['scenarios'][name] = _child(['--scenario', name, '--repeat', str(repeat)])
+    return results
+
+def compare(results, baseline, tolerance):
+    """ Compares results to baseline and returns a list of regressions,
+    each a (metric, baseline value, value) tuple. A metric regresses if
+    it is more than tolerance (a fraction) worse than the baseline.
+    """
+    pairs = [ ('import_time', baseline.get('import_time'), results['import_time']) ]
+    for name, metrics in results['scenarios'].items():
+        for metric, value in metrics.items():
+            old = baseline.get('scenarios', {}).get(name, {}).get(metric)
+            if metric != 'steps':
+                pairs.append((f"{name}.{metric}", old, value))
+    regressions = []
+    for metric, old, value in pairs:
+        if old is None or value is None:
+            continue
+        if metric.endswith(HIGHER_IS_BETTER):
+            worse = value < old/(1 + tolerance)
+        else:
+            worse = value > old*(1 + tolerance)
+        if worse:
+            regressions.append((metric, old, value))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the energyoptinator scenarios")
+    parser.add_argument('scenarios', nargs='*', default=list(SCENARIOS), help=f"scenarios to run, of {', '.join(SCENARIOS)}")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per scenario, the best counts")
+    parser.add_argument('--output', help="JSON file to write the results to")
+    parser.add_argument('--baseline', help="JSON file with earlier results to compare to")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="allowed slowdown as a fraction of the baseline")
+    parser.add_argument('--import-budget', type=float, help="only check that importing energyoptinator takes less than this many seconds")
+    parser.add_argument('--scenario', help=argparse.SUPPRESS)
+    parser.add_argument('--import-time', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # Child processes, see _child()
+    if args.import_time:
+        start = time.perf_counter()
+        import energyoptinator
+        elapsed = time.perf_counter() - start
+        print(json.dumps({ 'import_time': elapsed, 'heavy': [ m for m in HEAVY if m in sys.modules ] }))
+        return 0
+    if args.import_budget is not None:
+        return check_import(args.import_budget, args.repeat)
+    if args.scenario:
+        print(json.dumps(measure(args.scenario, args.repeat)))
+        return 0
+
+    results = run(args.scenarios, args.repeat)
+    print(f"import energyoptinator: {results['import_time']*1000:.0f} ms")
+    for name, metrics in results['scenarios'].items():
+        memory = metrics['peak_memory']
+        print( f"{name}: {metrics['wall_time']:.3f} s, {metrics['steps_per_second']:.0f} steps/s"
+             + (f", {memory/2**20:.0f} MiB peak" if memory is not None else "") )
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for metric, old, value in regressions:
+            print(f"REGRESSION {metric}: {old:.4g} -> {value:.4g}")
+        if regressions:
+            return 1
+        print(f"No regressions beyond {args.tolerance:.0%} of {args.baseline}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
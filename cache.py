@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+import hashlib
+import inspect
+import os
+import pickle
+import time
+from collections import OrderedDict
+from functools import wraps
+import numpy as np
+
+## CACHES
+#
+# ProfileCache memoizes functions building input profiles, keyed on
+# the function and all its arguments, in an in-process LRU and
+# optionally in a DiskCache shared by every process on a machine.
+#
+# ResultCache keeps whole simulation results on disk, keyed on
+# Simulation.fingerprint(), so run() of a simulation already simulated
+# by any process on the machine restores the results instead.
+
+class DiskCache:
+    suffix = '.npy'
+
+    def __init__(self, path, max_bytes=1<<30, max_age=None):
+        """ Creates an on-disk cache of numpy arrays in the directory
+        path. When the cache grows beyond max_bytes, the least recently
+        used files are removed, and with max_age, files not used for
+        max_age seconds are.
+        """
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+    def filename(self, key):
+        return os.path.join(self.path, hashlib.sha256(key.encode()).hexdigest() + self.suffix)
+
+    def get(self, key):
+        """ Returns the value stored under key, or None.
+        """
+        filename = self.filename(key)
+        try:
+            if self.max_age is not None and time.time() - os.stat(filename).st_mtime > self.max_age:
+                return None
+            with open(filename, 'rb') as f:
+                value = self.read(f)
+        except (FileNotFoundError, ValueError, EOFError, pickle.UnpicklingError):
+            return None
+        # Mark the file as recently used, unless another process has
+        # evicted it since; the value read is still good
+        try:
+            os.utime(filename)
+        except FileNotFoundError:
+            pass
+        return value
+
+    def put(self, key, value):
+        """ Stores value under key. The file is written under a
+        temporary name and moved in place, so other processes never
+        read a half written file.
+        """
+        filename = self.filename(key)
+        temporary = f"{filename}.{os.getpid()}.tmp"
+        with open(temporary, 'wb') as f:
+            self.write(f, value)
+        os.replace(temporary, filename)
+        self.evict()
+
+    def read(self, f):
+        return np.load(f)
+
+    def write(self, f, value):
+        np.save(f, value)
+
+    def evict(self):
+        """ Removes the files not used for max_age seconds, and then
+        the least recently used files until the cache fits in
+        max_bytes.
+        """
+        files = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(self.suffix):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        oldest = time.time() - self.max_age if self.max_age is not None else None
+        for mtime, size, filename in sorted(files):
+            if total <= self.max_bytes and (oldest is None or mtime >= oldest):
+                break
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class ResultCache(DiskCache):
+    suffix = '.pickle'
+
+    def __init__(self, path, max_bytes=4<<30, max_age=None):
+        """ Creates an on-disk cache of simulation results in the
+        directory path, see Simulation.run(). Every result is a
+        Simulation.checkpoint() snapshot, holding every series and the
+        reducers. Eviction works like for DiskCache.
+        """
+        super().__init__(path, max_bytes, max_age)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = super().get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def read(self, f):
+        return pickle.load(f)
+
+    def write(self, f, value):
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+class ProfileCache:
+    def __init__(self, maxsize=64, disk=None):
+        """ Creates a cache for profile building functions, keeping the
+        maxsize most recently used profiles in memory and, if disk is a
+        DiskCache, every profile on disk as well. Use an instance as a
+        decorator to cache a function.
+
+        Cached profiles are returned as read-only numpy arrays, since
+        they are shared by every caller.
+        """
+        self.maxsize = maxsize
+        self.disk = disk
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, function):
+        signature = inspect.signature(function)
+        version = []
+        @wraps(function)
+        def cached(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            if not version:
+                version.append(_code_digest(function))
+            try:
+                arguments = _arguments_digest(bound.arguments)
+            except ValueError:
+                # Arguments that can't be hashed can't be cached
+                return function(*args, **kwargs)
+            key = f"{function.__module__}.{function.__qualname__}:{version[0]}:{arguments}"
+            return self.get(key, lambda: function(*args, **kwargs))
+        return cached
+
+    def get(self, key, build):
+        """ Returns the profile stored under key, building it with
+        build() if it is in neither the memory nor the disk cache.
+        """
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        profile = self.disk.get(key) if self.disk is not None else None
+        if profile is None:
+            self.misses += 1
+            profile = np.array(build(), dtype=np.float64)
+            if self.disk is not None:
+                self.disk.put(key, profile)
+        else:
+            self.hits += 1
+        profile.flags.writeable = False
+        self.entries[key] = profile
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return profile
+
+    def clear(self):
+        self.entries.clear()
+
+
+def _arguments_digest(arguments):
+    """ Returns a digest of the values of arguments, a dictionary of
+    argument names and values, arrays included in full. Raises a
+    ValueError for values that can't be hashed.
+    """
+    from energyoptinator import _digest
+    h = hashlib.sha256()
+    _digest(h, tuple(arguments.items()))
+    return h.hexdigest()
+
+def _code_digest(function):
+    """ Returns a digest of the source of the module defining function
+    and of the modules next to it that it uses, so profiles cached by
+    an older version of the code, e.g. before a modifier table was
+    changed, are not used.
+    """
+    module = inspect.getmodule(function)
+    folder = os.path.dirname(os.path.abspath(getattr(module, '__file__', '') or ''))
+    modules = { module.__name__: module }
+    for value in vars(module).values():
+        other = value if inspect.ismodule(value) else inspect.getmodule(value)
+        filename = getattr(other, '__file__', None)
+        if filename and os.path.dirname(os.path.abspath(filename)) == folder:
+            modules[other.__name__] = other
+    h = hashlib.sha256()
+    for name in sorted(modules):
+        try:
+            h.update(inspect.getsource(modules[name]).encode())
+        except (OSError, TypeError):
+            h.update(name.encode())
+    return h.hexdigest()
+
+
+# Cache shared by the profile builders in svenska_schabloner. Setting
+# ENERGYOPTINATOR_CACHE to a directory enables the disk tier, also in
+# sweep workers.
+profile_cache = ProfileCache( disk = DiskCache(os.environ['ENERGYOPTINATOR_CACHE'])
+                                     if os.environ.get('ENERGYOPTINATOR_CACHE') else None )
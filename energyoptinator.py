@@ -1,122 +1,955 @@
 #!/usr/bin/env python3
 
+import copy
+import hashlib
+import inspect
 import math
-import matplotlib.pyplot as plt
-from scipy.signal import savgol_filter
+from array import array
+import os
+import pickle
+from datetime import datetime, timedelta
+import numpy as np
 
 class Simulation:
     def __init__( self
                 , name = ""
-                , grids = {}
-                , entities = {}
-                , storages = {} ):
+                , grids = None
+                , entities = None
+                , storages = None
+                , profile = False
+                , cache = None ):
         """ Initializes a simulation. The simulation object holds a
         reference to all grids and entities in the simulation. Every
         object has a name, and objects are expected to be stored in
         dictionaries.
 
         Entities are expected to add themselves to the reference lists.
+
+        With profile=True, the time spent in every grid, entity and
+        storage and in every regulator signal is recorded in
+        self.profiler, see profiler.Profiler, with profile='memory' the
+        memory allocated as well. Profiling starts when the simulation
+        is compiled, which run() and the first step() do.
+
+        cache is a cache.ResultCache, or the directory of one, where
+        run() looks up and stores results, see fingerprint(). By
+        default the directory in the environment variable
+        ENERGYOPTINATOR_RESULTS is used, if set, so every process on a
+        machine shares it.
         """
         self.name     = name
-        self.grids    = grids
-        self.entities = entities
-        self.storages = storages
+        self.grids    = grids if grids is not None else {}
+        self.entities = entities if entities is not None else {}
+        self.storages = storages if storages is not None else {}
+        self.plan = None
+        self.stepping = None
+        self.multirate = False
+        self.offset = 0
+        self.reducers = {}
+        self.reduced = 0
+        self.profiler = None
+        if profile:
+            from profiler import Profiler
+            self.profiler = Profiler(memory=profile == 'memory')
+        if cache is None:
+            cache = os.environ.get('ENERGYOPTINATOR_RESULTS') or None
+        if isinstance(cache, (str, os.PathLike)):
+            from cache import ResultCache
+            cache = ResultCache(cache)
+        self.cache = cache
     def step(self):
+        """ Simulates one time step, appending to every series. The
+        simulation is compiled on the first step, and again whenever
+        grids, entities or storages have been added, see compile().
+        """
+        if self.stepping != (len(self.grids), len(self.entities), len(self.storages)):
+            self._prepare()
+        for step in self.plan:
+            step()
+
+    def _prepare(self):
+        """ Compiles the simulation for step() and turns the numpy
+        arrays left by run() back into growable buffers, see _buffer().
+        Done once, until the simulation is compiled again.
+        """
+        self.compile()
+        if self.multirate:
+            raise ValueError("grids with different rates can only be simulated with run()")
+        if self.scenarios() is not None:
+            raise ValueError("batched scenarios can only be simulated with run()")
+        if any(isinstance(grid.powers[name], np.ndarray) for name, grid in self.grids.items()):
+            self._rebind(lambda series, dtype, rate: _buffer(series, dtype))
+        self.stepping = (len(self.grids), len(self.entities), len(self.storages))
+
+    def compile(self):
+        """ Freezes the topology of the simulation into a flat
+        execution plan. Every grid, entity and storage pre-resolves
+        direct references to the series it reads and writes, grids list
+        their contributors, and the step methods are collected in
+        stepping order, so step() and run() do no dictionary or
+        membership lookups per step.
+
+        step() and run() compile by themselves, and step() compiles
+        again when grids, entities or storages have been added since.
+        """
+        self.stepping = None
+        for obj in (*self.grids.values(), *self.entities.values(), *self.storages.values()):
+            obj.compile()
+        if self.profiler is not None:
+            self._instrument()
+        self.stateless = [ e for e in self.entities.values() if hasattr(e, 'fill') ]
+        self.stateful = [ e for e in self.entities.values() if not hasattr(e, 'fill') ]
+        self.multirate = any(g.rate != 1 for g in self.grids.values())
+        self.plan = ( [ e.step for e in self.entities.values() ]
+                    + [ g.step for g in self.grids.values() ]
+                    + [ s.step for s in self.storages.values() ] )
+        return self
+
+    def _instrument(self):
+        """ Wraps the step, fill and dispatch methods of every grid,
+        entity and storage, and every signal, in timers of the
+        profiler. Wrapping is done once, later calls do nothing.
+        """
+        profiler = self.profiler
+        for obj in (*self.grids.values(), *self.entities.values(), *self.storages.values()):
+            label = f"{type(obj).__name__} {obj.name}"
+            profiler.instrument(obj, ('step', 'step_at', 'fill', 'dispatch'), label)
+            if getattr(obj, 'signal', None):
+                obj.signal = profiler.wrap(obj.signal, f"{label}.signal")
+        self._leap = profiler.wrap(self._leap, "Simulation._leap")
+
+    def steps(self):
+        """ Returns the number of time steps simulated so far,
+        including those dropped from memory by stream().
+        """
+        for name, grid in self.grids.items():
+            return self.offset + len(grid.powers[name])*grid.rate
+        return self.offset
+
+    def regulators(self):
+        """ Returns a list of all regulators used by the entities in
+        the simulation, each regulator listed once.
+        """
+        regulators = []
         for _, entity in self.entities.items():
-            entity.step()
-        for _, grid in self.grids.items():
-            grid.step()
+            regulator = getattr(entity, 'regulator', None)
+            if regulator is not None and not any(r is regulator for r in regulators):
+                regulators.append(regulator)
+        return regulators
+
+    def run(self, n_steps, events=False):
+        """ Runs the simulation n_steps time steps in one go. Every
+        series is preallocated as a float64 numpy array, int8 for
+        regulator states, stateless entities (those with a fill()
+        method) are computed as whole-array operations up front, and
+        only stateful entities, the grids they contribute to and the
+        storages are stepped.
+
+        All series stay reachable through the same powers dictionaries,
+        charges and states as with step(), but are numpy arrays after
+        the run. Previously simulated steps are kept, so run() can be
+        called again to continue the simulation. step() can continue it
+        too, turning the series back into growable arrays first, except
+        for batched scenarios.
+
+        If any parameter is given per scenario, see scenarios(), all
+        scenarios are simulated at once and every series gets the
+        shape (steps, scenarios).
+
+        Grids with a rate other than 1 are stepped every rate time
+        steps, see Grid, and n_steps and the steps simulated so far must
+        then be multiples of every grid's rate.
+
+        With events=True, stretches where no regulator switches and no
+        storage changes between normal use, overflowing and being
+        emptied are computed as whole arrays, and only the steps where
+        that happens are stepped, see _run_events(). This requires
+        every stateful entity to have its own OnoffRegulator reading a
+        storage's soc(); otherwise, and for batched scenarios, run()
+        steps as usual.
+
+        If the simulation has a result cache, see __init__(), the first
+        run() looks for the results of a simulation with the same
+        fingerprint() and number of steps, and restores them, reducers
+        included, if found. Otherwise the results are stored there.
+        """
+        start = self.steps() - self.offset
+        stop = start + n_steps
+        period = self.period()
+        if start % period or n_steps % period:
+            raise ValueError(f"run() must start and stop at multiples of {period} time steps, the grids' rates")
+        key = self._cache_key(n_steps)
+        if key is not None:
+            snapshot = self.cache.get(key)
+            if snapshot is not None:
+                return self.restore(snapshot)
+        scenarios = self.scenarios()
+        shape = (stop,) if scenarios is None else (stop, scenarios)
+        self._rebind(lambda series, dtype, rate: _preallocate(series, (stop//rate,) + shape[1:], dtype))
+        stateful = self.stateful
+        for entity in self.stateless:
+            rate = entity.grid.rate
+            entity.fill(start//rate, stop//rate, self.offset//rate)
+        grids = [ g for g in self.grids.values() if g.fill(start//g.rate, stop//g.rate) ]
+        dispatched = self._dispatchable(stateful, grids)
+        for storage in dispatched:
+            storage.dispatch(start//storage.grid.rate, stop//storage.grid.rate)
+        storages = [ s for s in self.storages.values() if s not in dispatched ]
+        if (stateful or storages) and self.multirate:
+            if scenarios is None:
+                self._rebind(lambda series, dtype, rate: _buffer(series, dtype))
+            self._run_rates(start, stop, period, stateful, grids, storages)
+            if scenarios is None:
+                self._rebind(lambda series, dtype, rate: np.array(series, dtype=dtype))
+        elif (stateful or storages) and events and scenarios is None and self._predictable(stateful):
+            self._run_events(start, stop, stateful, grids, storages)
+        elif stateful or storages:
+            # Element access is a lot cheaper on typed arrays than on
+            # numpy arrays, so the stepped part runs on array.array
+            # buffers, see _buffer(). Batched scenarios step whole rows
+            # of the numpy arrays instead. Grids nothing reads while
+            # stepping are summed afterwards, see _deferrable().
+            deferred = []
+            if scenarios is None:
+                deferred = self._deferrable(stateful, grids)
+                grids = [ g for g in grids if not any(g is d for d in deferred) ]
+                self._rebind(lambda series, dtype, rate: _buffer(series, dtype))
+            for t in range(start, stop):
+                for entity in stateful:
+                    entity.step_at(t)
+                for grid in grids:
+                    grid.step_at(t)
+                for storage in storages:
+                    storage.step_at(t)
+            if scenarios is None:
+                self._rebind(lambda series, dtype, rate: np.array(series, dtype=dtype))
+            if deferred:
+                self._balance(deferred, start, stop)
+        self._reduce()
+        if key is not None:
+            self.cache.put(key, self.checkpoint())
+        return self
+
+    def fingerprint(self):
+        """ Returns a hash of everything the results of the simulation
+        depend on: every attribute of its grids, entities, storages,
+        regulators and reducers, including the contents of every input
+        profile, which objects they refer to, the functions feeding the
+        reducers, the classes of all of them and the simulation code
+        itself. Classes defined outside this module are hashed by their
+        source. Compiles the simulation first, see compile().
+
+        Raises a ValueError if any of it can't be hashed, like a lambda
+        signal, a live input or a class without source.
+        """
+        self.compile()
+        series = set()
+        for owner in (*self.grids.values(), *self.entities.values(), *self.storages.values()):
+            series.update(id(s) for s in owner.powers.values())
+        series.update(id(s.charges) for s in self.storages.values())
+        regulators = self.regulators()
+        series.update(id(r.states) for r in regulators)
+
+        def reference(value):
+            # Series are the results, other simulation objects are
+            # hashed by name where they are defined
+            if id(value) in series or isinstance(value, (_Averaged, _Held)):
+                return 'series'
+            if value is self:
+                return 'simulation'
+            for kind, objects in (('grid', self.grids), ('entity', self.entities), ('storage', self.storages)):
+                for name, obj in objects.items():
+                    if value is obj:
+                        return (kind, name)
+            for index, regulator in enumerate(regulators):
+                if value is regulator:
+                    return ('regulator', index)
+            # Profiled methods keep the method they time in .method
+            method = getattr(value, 'method', value)
+            if callable(value) and getattr(method, '__self__', None) is not None:
+                return ('method', reference(method.__self__), method.__name__)
+            if inspect.isfunction(value):
+                # Lambdas on one line share their source, not their code
+                code = value.__code__
+                return ( 'function', value.__module__, value.__qualname__, _source(value)
+                       , code.co_code.hex(), code.co_names
+                       , repr(tuple(c for c in code.co_consts if not inspect.iscode(c)))
+                       , reference(value.__defaults__ or ())
+                       , reference(tuple(cell.cell_contents for cell in value.__closure__ or ())) )
+            if isinstance(value, dict):
+                return tuple((key, reference(v)) for key, v in value.items())
+            if isinstance(value, (list, tuple)):
+                return tuple(reference(v) for v in value)
+            return value
+
+        def describe(kind, name, obj):
+            cls = type(obj)
+            _digest(h, (kind, name, cls.__module__, cls.__qualname__))
+            for base in cls.__mro__:
+                if base.__module__ not in (__name__, 'builtins'):
+                    _digest(h, _source(base))
+            for attr, value in _attributes(obj):
+                _digest(h, (attr, reference(value)))
+
+        h = hashlib.sha256(_source_digest())
+        for kind, objects in (('grid', self.grids), ('entity', self.entities), ('storage', self.storages)):
+            for name, obj in objects.items():
+                describe(kind, name, obj)
+        for index, regulator in enumerate(regulators):
+            describe('regulator', index, regulator)
+        for name, (reducer, function) in self.reducers.items():
+            describe('reducer', name, reducer)
+            _digest(h, reference(function))
+        return h.hexdigest()
+
+    def _cache_key(self, n_steps):
+        """ Returns the result cache key of running n_steps time steps,
+        or None if there is no cache, the simulation has been run
+        before or can't be fingerprinted.
+        """
+        if self.cache is None or self.steps() != 0:
+            return None
+        try:
+            return f"{self.fingerprint()}:{n_steps}"
+        except ValueError:
+            return None
+
+    def run_optimal(self, n_steps, costs=None, unmet=1000, cyclic=False):
+        """ Runs the simulation n_steps time steps with perfect foresight:
+        instead of following their regulators, the stateful entities
+        are dispatched by a linear program minimizing the total cost
+        over the whole horizon, see lpdispatch.dispatch(). The series
+        are filled like by run(), with regulator states 1 wherever the
+        entity runs at all.
+
+        Since entities may run at any part of their rated power, the
+        cost is a lower bound for what any regulator can achieve, e.g.
+        the least possible generator fuel for a battery size.
+
+        costs is a dictionary of grid names and costs per unit drawn
+        from or fed to the grid by the stateful entities; by default,
+        every grid without storages costs 1. unmet is the cost per unit
+        of demand left unmet on grids with storages. With cyclic=True,
+        every storage must end with at least the charge it started
+        with.
+
+        Requires every grid to step at rate 1, no batched scenarios and
+        a factors() method on every stateful entity. Returns the
+        scipy.optimize.linprog() result, whose fun is the total cost.
+        """
+        if self.scenarios() is not None:
+            raise ValueError("run_optimal() doesn't support batched scenarios")
+        if self.period() != 1:
+            raise ValueError("run_optimal() requires every grid to step at rate 1")
+        missing = [ name for name, e in self.entities.items() if not hasattr(e, 'fill') and not hasattr(e, 'factors') ]
+        if missing:
+            raise ValueError(f"entities without factors() can't be dispatched: {', '.join(missing)}")
+        start = self.steps() - self.offset
+        stop = start + n_steps
+        self._rebind(lambda series, dtype, rate: _preallocate(series, (stop,), dtype))
+        for entity in self.stateless:
+            entity.fill(start, stop, self.offset)
+        for grid in self.grids.values():
+            grid.fill(start, stop)
+        from lpdispatch import dispatch
+        result = dispatch(self, start, stop, costs, unmet, cyclic)
+        self._reduce()
+        return result
+
+    def _reduce(self):
+        """ Feeds every reducer the steps simulated since the last
+        call, by run() or by step(), and counts them in self.reduced.
+        """
+        start = self.reduced - self.offset
+        stop = self.steps() - self.offset
+        self.reduced = self.offset + stop
+        if stop <= start:
+            return
+        for _, (reducer, series) in self.reducers.items():
+            data = series(self)
+            # Series of slower grids have one value per rate steps
+            rate = stop // len(data) if len(data) else 1
+            reducer.update(data[start//rate:stop//rate])
+
+    def period(self):
+        """ Returns the number of time steps after which every grid
+        has completed a step, the least common multiple of their rates.
+        """
+        return math.lcm(*(g.rate for g in self.grids.values()))
+
+    def _run_rates(self, start, stop, period, stateful, grids, storages):
+        """ Stepped part of run() for grids with different rates.
+        Every time step, the entities due to start a step are stepped,
+        and then the grids and storages whose step ends there. Within
+        a period the pattern repeats, so it is worked out beforehand.
+        """
+        schedule = []
+        for phase in range(period):
+            schedule.append( [ (e.step_at, e.rate) for e in stateful if phase % e.rate == 0 ]
+                           + [ (g.step_at, g.rate) for g in grids if (phase+1) % g.rate == 0 ]
+                           + [ (s.step_at, s.grid.rate) for s in storages if (phase+1) % s.grid.rate == 0 ] )
+        for t in range(start, stop):
+            for step_at, rate in schedule[t % period]:
+                step_at(t // rate)
+
+    def _predictable(self, stateful):
+        """ Returns True if the next regulator switch can be predicted
+        from the storage charges, i.e. every stateful entity has an
+        OnoffRegulator of its own, with a storage's soc() as signal or
+        no signal at all.
+        """
+        regulators = []
+        for entity in stateful:
+            regulator = getattr(entity, 'regulator', None)
+            if not isinstance(regulator, OnoffRegulator) or any(r is regulator for r in regulators):
+                return False
+            regulators.append(regulator)
+            owner = getattr(entity.signal, '__self__', None)
+            if entity.signal and not any(owner is s for s in self.storages.values()):
+                return False
+        return True
+
+    def _run_events(self, start, stop, stateful, grids, storages):
+        """ Event-driven stepping for run(events=True). Every event,
+        a regulator switch or a storage filling up or running empty, is
+        stepped as usual, after which _leap() computes the stretch up to
+        the next event as whole arrays. The look-ahead window grows
+        while no events are found and shrinks to the stretches found.
+        """
+        balanced = list(grids)
+        for storage in storages:
+            if not any(storage.grid is g for g in balanced):
+                balanced.append(storage.grid)
+        window = 64
+        t = start
+        while t < stop:
+            for entity in stateful:
+                entity.step_at(t)
+            for grid in grids:
+                grid.step_at(t)
+            for storage in storages:
+                storage.step_at(t)
+            n = min(window, stop - t - 1)
+            if n <= 0:
+                break
+            leap = self._leap(t, n, stateful, grids, balanced, storages)
+            window = min(2*window, 8192) if leap == n else max(64, 2*leap)
+            t += leap + 1
+
+    def _leap(self, t, n, stateful, grids, balanced, storages):
+        """ Computes up to n steps after time step t as whole arrays,
+        assuming no regulator switches, and stops at the first step
+        where a regulator would switch or a storage changes state.
+        Writes the steps before it, giving the same results as stepping,
+        and returns their number.
+        """
+        balances = {}
+        for grid in balanced:
+            balance = grid.balance[t+1:t+1+n].copy()
+            if any(grid is g for g in grids):
+                for power in grid.stateful:
+                    balance += power[t]
+            balances[grid.name] = balance
+        trajectories = []
+        for storage in storages:
+            charges, power, residual = _leap_storage( balances[storage.grid.name][:n]
+                                                    , storage.charges[t]
+                                                    , storage.capacity
+                                                    , getattr(storage, 'selfDischargeRate', 0)*storage.capacity )
+            n = len(charges)
+            balances[storage.grid.name] = residual
+            trajectories.append((storage, charges, power))
+        for entity in stateful:
+            if not entity.signal:
+                continue
+            storage = entity.signal.__self__
+            charges = next(c for s, c, _ in trajectories if s is storage)
+            soc = np.concatenate(([storage.charges[t]], charges[:n-1]))/storage.capacity
+            regulator = entity.regulator
+            if regulator.states[t] == 1:
+                switch = soc > regulator.offThr
+            else:
+                switch = soc < regulator.onThr
+            n = _leading(~switch[:n])
+        if n == 0:
+            return 0
+        steps = slice(t+1, t+1+n)
+        for entity in stateful:
+            if entity.signal:
+                entity.regulator.states[steps] = entity.regulator.states[t]
+            for _, series in entity.powers.items():
+                series[steps] = series[t]
+        for grid in balanced:
+            grid.balance[steps] = balances[grid.name][:n]
+        for storage, charges, power in trajectories:
+            storage.charges[steps] = charges[:n]
+            storage.output[steps] = power[:n]
+            storage.charge = storage.charges[t+n]
+        return n
+
+    def add_reducer(self, name, reducer, series):
+        """ Adds a reducer, like Sum() or Starts(), under the given
+        name. series is a function taking the simulation and returning
+        the series to reduce, e.g.
+        lambda s: s.grids['Gasoline'].powers['Generator']. Every run()
+        feeds the reducer the newly simulated part of the series, which
+        for a grid with a rate other than 1 has one value per rate time
+        steps. Steps simulated with step() are fed when results() is
+        called, or before they could be dropped from memory. Only steps
+        simulated after the reducer is added are counted.
+        """
+        self._reduce()
+        self.reducers[name] = (reducer, series)
+
+    def results(self):
+        """ Returns a dictionary with the current value of every
+        reducer, fed every step simulated so far.
+        """
+        self._reduce()
+        return { name: reducer.value for name, (reducer, _) in self.reducers.items() }
+
+    def stream(self, n_steps, chunk=8760, window=1, store=None, checkpoint=None):
+        """ Runs the simulation n_steps time steps with bounded memory.
+        The simulation is run() chunk steps at a time, and after every
+        chunk only the last window steps of every series are kept.
+        Totals, extremes, start counts etc. have to be collected with
+        reducers, see add_reducer(), or every series can be written to
+        the result store directory store as it is simulated, see
+        store.open_results(). Returns results().
+
+        If checkpoint is a file name, the simulation is checkpointed
+        there after every chunk, so an interrupted stream can be picked
+        up with restore() and a stream() of the remaining steps.
+        """
+        if window < 1:
+            raise ValueError("stream() must keep a window of at least one step")
+        if store is not None:
+            from store import ResultStore
+            store = ResultStore(store, self, n_steps)
+        remaining = n_steps
+        while remaining > 0:
+            start = self.steps()
+            self.run(min(chunk, remaining))
+            remaining -= min(chunk, remaining)
+            if store is not None:
+                store.write(start, self.steps())
+            self._truncate(window)
+            if checkpoint is not None:
+                self.checkpoint(checkpoint)
+        if store is not None:
+            store.flush()
+        return self.results()
+
+    def save(self, path):
+        """ Writes every series still in memory to a result store in
+        the directory path, see store.open_results().
+        """
+        from store import ResultStore
+        store = ResultStore(path, self, self.steps() - self.offset, self.offset)
+        store.write(self.offset, self.steps())
+        store.flush()
+
+    def checkpoint(self, path=None, window=None):
+        """ Returns a snapshot of the simulation's state: every series
+        with the charges of the storages and the states of the
+        regulators, the reducers and the number of steps simulated. The
+        positions in time-variant inputs follow from the number of
+        steps. With window, only the last window steps of every series
+        are kept, which is enough to go on simulating.
+
+        If path is given, the snapshot is also written to that file, in
+        a way that never leaves a half written file behind.
+        """
+        self._reduce()
+        period = self.period()
+        dropped = 0
+        if window is not None:
+            dropped = max(0, (self.steps() - self.offset - window) // period * period)
+        keep = lambda series, rate: np.array(series[dropped//rate:])
+        snapshot = { 'steps': self.steps()
+                   , 'offset': self.offset + dropped
+                   , 'grids': { gridname: { name: keep(series, grid.rate) for name, series in grid.powers.items() }
+                                for gridname, grid in self.grids.items() }
+                   , 'storages': { name: (keep(storage.charges, storage.grid.rate), storage.charge)
+                                   for name, storage in self.storages.items() }
+                   , 'regulators': {}
+                   , 'reducers': { name: copy.deepcopy(reducer) for name, (reducer, _) in self.reducers.items() }
+                   }
+        for name, regulator in self._regulated():
+            snapshot['regulators'][name] = keep(regulator.states, self.entities[name].rate)
+        if path is not None:
+            temporary = f"{path}.{os.getpid()}.tmp"
+            with open(temporary, 'wb') as f:
+                pickle.dump(snapshot, f)
+            os.replace(temporary, path)
+        return snapshot
+
+    def restore(self, snapshot):
+        """ Returns the simulation to a snapshot taken by checkpoint(),
+        or read from the file snapshot was written to. Entities and
+        storages added since the snapshot get zeroed series up to it,
+        so they take part from the snapshot on, with storages starting
+        out empty. Returns the simulation.
+        """
+        if isinstance(snapshot, (str, os.PathLike)):
+            with open(snapshot, 'rb') as f:
+                snapshot = pickle.load(f)
+        empty = lambda: np.zeros(0)
+        for gridname, grid in self.grids.items():
+            saved = snapshot['grids'].get(gridname, {})
+            for name in grid.powers:
+                series = saved[name].copy() if name in saved else empty()
+                grid.powers[name] = series
+                owner = self.entities.get(name) or self.storages.get(name)
+                if owner is not None:
+                    owner.powers[gridname] = series
+        for name, storage in self.storages.items():
+            charges, charge = snapshot['storages'].get(name, (empty(), 0))
+            storage.charges = charges.copy()
+            storage.charge = charge
+        for name, regulator in self._regulated():
+            regulator.states = snapshot['regulators'].get(name, np.zeros(0, dtype=np.int8)).copy()
+        for name, reducer in snapshot['reducers'].items():
+            if name in self.reducers:
+                self.reducers[name] = (copy.deepcopy(reducer), self.reducers[name][1])
+        self.offset = snapshot['offset']
+        self.reduced = snapshot['steps']
+        return self.compile()
+
+    def resume(self, snapshot, stop, modify=None):
+        """ Re-simulates from a snapshot up to time step stop, e.g. to
+        see what changing a threshold from month 6 on would do without
+        simulating the first five months again. The snapshot is
+        restored, modify(self) may then change parameters or add
+        entities, and the remaining steps are run. Resume a
+        copy.deepcopy() of the simulation to keep the original results.
+        """
+        self.restore(snapshot)
+        if modify is not None:
+            modify(self)
+        return self.run(stop - self.steps())
+
+    def _regulated(self):
+        """ Returns (entity name, regulator) for every regulator, named
+        by the first entity using it, like regulators() lists them.
+        """
+        regulated = []
+        for name, entity in self.entities.items():
+            regulator = getattr(entity, 'regulator', None)
+            if regulator is not None and not any(r is regulator for _, r in regulated):
+                regulated.append((name, regulator))
+        return regulated
+
+    def _truncate(self, window):
+        """ Drops all but the last window steps of every series,
+        keeping track of the dropped steps in self.offset. With grids
+        of different rates, whole periods are dropped, so a few more
+        steps may be kept.
+        """
+        self._reduce()
+        period = self.period()
+        dropped = (self.steps() - self.offset - window) // period * period
+        if dropped > 0:
+            self.offset += dropped
+            self._rebind(lambda series, dtype, rate: np.array(series[dropped//rate:], dtype=dtype))
+
+    def scenarios(self):
+        """ Returns the number of scenarios in the simulation, or None
+        if it is an ordinary single scenario simulation.
+
+        Every parameter listed in a class' parameters, like
+        SimpleSolar.area, Battery.capacity or OnoffRegulator.onThr, may
+        be given as a list or array with one value per scenario, and
+        time-variant data listed in a class' profiles may be given as a
+        (steps, scenarios) array. Lists and tuples are converted to
+        numpy arrays. All per-scenario values must have the same number
+        of scenarios.
+        """
+        shape = ()
+        for obj in (*self.entities.values(), *self.storages.values(), *self.regulators()):
+            for attr in getattr(obj, 'parameters', ()):
+                value = getattr(obj, attr)
+                if isinstance(value, (list, tuple)):
+                    value = np.asarray(value, dtype=np.float64)
+                    setattr(obj, attr, value)
+                shape = np.broadcast_shapes(shape, np.shape(value))
+            for attr in getattr(obj, 'profiles', ()):
+                value = getattr(obj, attr)
+                if isinstance(value, np.ndarray) and value.ndim > 1:
+                    shape = np.broadcast_shapes(shape, value.shape[1:])
+        if len(shape) > 1:
+            raise ValueError(f"scenario parameters must be one-dimensional, got shape {shape}")
+        return shape[0] if shape else None
+
+    def _dispatchable(self, stateful, grids):
+        """ Returns the storages that can be dispatched over the whole
+        horizon at once: those on grids without stateful contributors,
+        whose state of charge no regulator reads. If any stateful
+        entity has a signal that is not a storage method, no storage is
+        considered safe.
+        """
+        watched = []
+        for entity in stateful:
+            signal = getattr(entity, 'signal', None)
+            if signal:
+                owner = getattr(signal, '__self__', None)
+                if not any(owner is s for s in self.storages.values()):
+                    return []
+                watched.append(owner)
+        dispatchable = []
         for _, storage in self.storages.items():
-            storage.step()
+            if any(storage.grid is g for g in grids):
+                continue
+            # All storages on a grid are dispatched the same way, since
+            # they take turns at the grid balance.
+            shared = [ s for s in self.storages.values() if s.grid is storage.grid ]
+            if not any(s is w for s in shared for w in watched):
+                dispatchable.append(storage)
+        return dispatchable
 
-    def plot_grids(self):
-        fig = plt.figure(1)
+    def _deferrable(self, stateful, grids):
+        """ Returns the grids among grids whose balance needn't be
+        known while stepping: those without storages, whose stateful
+        contributors all have factors(). Their stateful contributions
+        can then be added after stepping, see _balance(). If any
+        stateful entity has a signal that is not a storage method, no
+        grid is considered safe.
+        """
+        for entity in stateful:
+            owner = getattr(getattr(entity, 'signal', None), '__self__', None)
+            if entity.signal and not any(owner is s for s in self.storages.values()):
+                return []
+        deferrable = []
+        for grid in grids:
+            if any(s.grid is grid for s in self.storages.values()):
+                continue
+            if all(hasattr(e, 'factors') for e in stateful if grid.name in e.powers):
+                deferrable.append(grid)
+        return deferrable
+
+    def _balance(self, grids, start, stop):
+        """ Adds the stateful contributions between start and stop to
+        the balances of grids, as one product of the activities of the
+        stateful entities and the incidence matrix, see incidence().
+        """
+        incidence = self.incidence()
+        rows = [ i for i, (name, port) in enumerate(incidence.rows)
+                 if port is None and any(self.entities[name] is e for e in self.stateful) ]
+        columns = [ incidence.columns.index(g.name) for g in grids ]
+        incidence = incidence.select(rows, columns)
+        balances = incidence.product(self.activities(start, stop, incidence.rows))
+        for j, grid in enumerate(grids):
+            grid.balance[start:stop] += balances[:, j]
+
+    def incidence(self):
+        """ Returns the entity×grid incidence matrix of the simulation,
+        see Incidence. An entity with a factors() method, like the
+        boilers, is one row: its activity is the output of its
+        regulator, and its factors the power per unit of activity on
+        each of its grids. Every other entity has one row per grid it
+        is on, with its power there as activity and a factor of 1.
+        """
+        columns = list(self.grids)
+        rows = []
+        entries = []
+        for name, entity in self.entities.items():
+            if hasattr(entity, 'factors'):
+                entries += [ (len(rows), columns.index(grid), factor) for grid, factor in entity.factors().items() ]
+                rows.append((name, None))
+            else:
+                for grid in entity.powers:
+                    entries.append((len(rows), columns.index(grid), 1))
+                    rows.append((name, grid))
+        return Incidence(rows, columns, entries)
+
+    def activities(self, start=0, stop=None, rows=None):
+        """ Returns the activities of the rows of incidence(), or of the
+        given rows, between start and stop as a (steps, rows) array.
+        Requires every grid to step at rate 1.
+        """
+        if self.multirate:
+            raise ValueError("activities are only defined for grids stepping every time step")
+        stop = self.steps() - self.offset if stop is None else stop
+        rows = self.incidence().rows if rows is None else rows
+        activities = np.zeros((stop - start, len(rows)))
+        for j, (name, port) in enumerate(rows):
+            entity = self.entities[name]
+            if port is not None:
+                activities[:, j] = entity.powers[port][start:stop]
+            elif entity.signal:
+                states = np.asarray(entity.regulator.states[start:stop], dtype=np.float64)
+                activities[:, j] = 1 - states if entity.regulator.flip else states
+        return activities
+
+    def balances(self, start=0, stop=None):
+        """ Returns the balance of every grid between start and stop
+        before storages, i.e. what the entities put on and take off the
+        grids, as a (steps, grids) array in the order of self.grids:
+        the product of activities() and incidence().
+        """
+        return self.incidence().product(self.activities(start, stop))
+
+    def _rebind(self, convert):
+        """ Replaces every series in the simulation with
+        convert(series, dtype, rate), where rate is the number of time
+        steps per value of the series. Entity series are shared with
+        their grids, so both references are updated, and the simulation
+        is recompiled to resolve the new series.
+        """
+        for owners in (self.entities, self.storages):
+            for name, owner in owners.items():
+                for gridname, series in owner.powers.items():
+                    grid = self.grids[gridname]
+                    owner.powers[gridname] = convert(series, np.float64, grid.rate)
+                    grid.powers[name] = owner.powers[gridname]
         for name, grid in self.grids.items():
-            ax = plt.plot(grid.powers[name], label=name)
-        fig.legend()
-        plt.title(self.name)
-        plt.savefig(f"Grids in {self.name}", dpi=96)
+            grid.powers[name] = convert(grid.powers[name], np.float64, grid.rate)
+        for _, storage in self.storages.items():
+            storage.charges = convert(storage.charges, np.float64, storage.grid.rate)
+        converted = []
+        for _, entity in self.entities.items():
+            regulator = getattr(entity, 'regulator', None)
+            if regulator is not None and not any(r is regulator for r in converted):
+                converted.append(regulator)
+                regulator.states = convert(regulator.states, np.int8, entity.rate)
+        self.compile()
+
+    def plot_grids(self):
+        """ Saves a figure of every grid balance, see plotting.render().
+        """
+        from plotting import render
+        render(self, f"Grids in {self.name}", 'grids')
 
     def plot_storages(self):
-        fig = plt.figure(1)
-        for name, storage in self.storages.items():
-            ax = plt.plot(storage.charges, label=name)
-        fig.legend()
-        plt.title(self.name)
-        plt.savefig(f"Storages in {self.name}", dpi=96)
+        """ Saves a figure of every storage's charge, see
+        plotting.render().
+        """
+        from plotting import render
+        render(self, f"Storages in {self.name}", 'storages')
 
     def plot_all(self):
-        n = len(self.grids.items())
-        m = len(self.storages.items())
-        fig, axlist = plt.subplots(math.ceil((n+m)/2), 2, figsize=(16, 4.5*n/2), dpi=120)
-        for ax, (gridname, grid) in zip(axlist.flatten()[:n], self.grids.items()):
-            for name, data in grid.powers.items():
-                ax.plot(hourly_to_weekly(_6min_to_hourly(data)), label=name)
-            ax.set_title(gridname)
-            ax.set_xlabel(grid.timesteplabel)
-            ax.set_ylabel(grid.unit)
-            ax.legend( bbox_to_anchor=(1.05, 1) )
-        for ax, (storagename, storage) in zip(axlist.flatten()[n:], self.storages.items()):
-            ax.plot([ c/storage.capacity for c in _6min_to_hourly([i/10 for i in storage.charges[1:] ] ) ], label=storagename)
-            ax.set_title(f"{storagename}, {storage.capacity} kWh")
-            ax.set_ylabel('SoC')
-            ax.set_xlabel('Hour')
-            ax.legend( bbox_to_anchor=(1.05, 1) )
-        fig.suptitle(self.name)
-        plt.tight_layout()
-        plt.savefig(self.name, dpi=96)
+        """ Saves an overview figure of every grid and storage, see
+        plotting.render().
+        """
+        from plotting import render
+        render(self, self.name, 'all')
 
 
 class Grid:
-    def __init__(self, name, sim, unit = 'kW', timesteplabel = 'Week'):
+    def __init__(self, name, sim, unit = 'kW', timesteplabel = 'Week', rate = 1):
         """ Creates a new Grid object. The new Grid object holds its
         name, places a reference to itself in the simulation it belongs
         to, and contains a dictionary with lists of all contributing
         powers.
+
+        rate is the number of simulation time steps per grid step. A
+        slow grid, like a heat grid with a large accumulator, can be
+        stepped e.g. every 10 time steps, which saves the work of
+        stepping it, its storages and its entities in between. Every
+        power on the grid is then the mean power over its grid step,
+        and profiles of entities on the grid must be given at the
+        grid's resolution, see resample(). Only run() supports grids
+        with different rates.
         """
         self.name = name
         self.sim = sim
         sim.grids[name] = self
         self.unit = unit
         self.timesteplabel = timesteplabel
-        self.powers = { self.name : [] }
+        self.rate = rate
+        self.powers = { self.name : array('d') }
+        self.contributors = None
 
-    def step(self):
-        self.powers[self.name].append(0)
+    def compile(self):
+        """ Pre-resolves the grid balance series and the series of all
+        contributing entities, split in stateless (those with a fill()
+        method) and stateful ones, see Simulation.compile().
+        """
+        self.balance = self.powers[self.name]
+        self.contributors = []
+        self.stateless = []
+        self.stateful = []
         for name, power in self.powers.items():
             if name in self.sim.entities.keys():
-                self.powers[self.name][-1] += power[-1]
+                self.contributors.append(power)
+                if hasattr(self.sim.entities[name], 'fill'):
+                    self.stateless.append(power)
+                else:
+                    self.stateful.append(power)
+
+    def step(self):
+        if self.contributors is None:
+            self.powers[self.name].append(0)
+            for name, power in self.powers.items():
+                if name in self.sim.entities.keys():
+                    self.powers[self.name][-1] += power[-1]
+        else:
+            balance = 0
+            for power in self.contributors:
+                balance += power[-1]
+            self.balance.append(balance)
+
+    def fill(self, start, stop):
+        """ Sums all stateless contributions to the grid between start
+        and stop as whole arrays. Contributions from stateful entities
+        are left for step_at(). Returns True if the grid has stateful
+        contributors and must be stepped. Requires compile().
+        """
+        self.balance[start:stop] = 0
+        for power in self.stateless:
+            self.balance[start:stop] += power[start:stop]
+        return bool(self.stateful)
+
+    def step_at(self, t):
+        """ Adds the stateful contributions of time step t to the
+        grid balance. Requires fill() to have been called first.
+        """
+        balance = self.balance
+        for power in self.stateful:
+            balance[t] += power[t]
 
     def plot(self):
         """ Grid.plot() plots a time diagram of all additions and
         subtractions from the grid, one series per connected entity.
         """
-        fig = plt.figure(1)
+        import matplotlib.pyplot as plt
+        from plotting import decimate
+        fig, ax = plt.subplots()
         for name, power in self.powers.items():
-            ax = plt.plot(power, label=name)
+            ax.plot(*decimate(power), label=name)
         fig.legend()
-        plt.ylabel(self.unit)
-        plt.xlabel(self.timesteplabel)
-        plt.title(self.name)
-        plt.tight_layout()
+        ax.set_ylabel(self.unit)
+        ax.set_xlabel(self.timesteplabel)
+        ax.set_title(self.name)
+        fig.tight_layout()
         plt.show()
 
     def plot_smoothed(self):
         """ Grid.plot() plots a time diagram of all additions and
         subtractions from the grid, one series per connected entity,
-        but smoothed.
+        but smoothed. The series are averaged to hourly values first
+        and smoothed over about eight days.
         """
-        fig = plt.figure(1)
+        import matplotlib.pyplot as plt
+        from plotting import decimate
+        step = SIX_MINUTES*self.rate
+        fig, ax = plt.subplots()
         for name, power in self.powers.items():
-            ax = plt.plot(savgol_filter(power, 2001, 3), label=name)
+            hourly = resample(power, step, HOUR, how='mean')
+            window = min(201, len(hourly) - 1 + len(hourly) % 2)
+            x, smoothed = decimate(savgol_filter(hourly, window, 3, axis=0))
+            ax.plot(x*(HOUR/step), smoothed, label=name)
         fig.legend()
-        plt.ylabel(self.unit)
-        plt.xlabel(self.timesteplabel)
-        plt.title(self.name)
+        ax.set_ylabel(self.unit)
+        ax.set_xlabel(self.timesteplabel)
+        ax.set_title(self.name)
         plt.show()
 
 
 class SimpleSource:
+    __slots__ = ('name', 'grid', 'power', 'powers', 'output')
+    parameters = ('power',)
+
     def __init__(self, name, sim, grid, power):
         """ SimpleSource is the simplest possible source, it adds its
         self.power to its self.grid every time step. There is no unit
@@ -126,14 +959,28 @@ class SimpleSource:
         sim.entities[name] = self
         self.grid = sim.grids[grid]
         self.power = power
-        self.powers = { self.grid.name : [] }
+        self.powers = { self.grid.name : array('d') }
         self.grid.powers[self.name] = self.powers[self.grid.name]
+        self.compile()
+
+    def compile(self):
+        """ Pre-resolves the series the entity writes to, see
+        Simulation.compile().
+        """
+        self.output = self.powers[self.grid.name]
 
     def step(self):
-        self.powers[self.grid.name].append(self.power)
+        self.output.append(self.power)
+
+    def fill(self, start, stop, offset=0):
+        self.output[start:stop] = self.power
 
 
 class TimevariantSource:
+    __slots__ = ('name', 'grid', 'supply', 'powers', 'output', 'offset')
+    parameters = ()
+    profiles = ('supply',)
+
     def __init__(self, name, sim, grid, supply):
         """ TimevariantSink takes a list or tuple of data as input,
         and appends the appropriate time step to its power output
@@ -143,14 +990,33 @@ class TimevariantSource:
         sim.entities[name] = self
         self.grid   = sim.grids[grid]
         self.supply = supply
-        self.powers = { self.grid.name : [] }
+        self.powers = { self.grid.name : array('d') }
         self.grid.powers[self.name] = self.powers[self.grid.name]
+        self.compile()
+
+    def compile(self):
+        """ Pre-resolves the series the entity writes to, and the
+        number of time steps dropped from its beginning, see
+        Simulation.compile() and Simulation.stream().
+        """
+        self.output = self.powers[self.grid.name]
+        self.offset = self.grid.sim.offset
 
     def step(self):
-        self.powers[self.grid.name].append(self.supply[len(self.powers[self.grid.name])])
+        self.output.append(self.supply[self.offset + len(self.output)])
+
+    def fill(self, start, stop, offset=0):
+        """ Fills the output from start to stop, offset is the number
+        of time steps dropped from the output's beginning, see
+        Simulation.stream().
+        """
+        self.output[start:stop] = _window(self.supply, offset+start, offset+stop, self.output.ndim)
 
 
 class SimpleSink:
+    __slots__ = ('name', 'grid', 'power', 'powers', 'output')
+    parameters = ('power',)
+
     def __init__(self, name, sim, grid, power):
         """ SimpleSink is the simplest possible sink, it subtracts its
         self.power to its self.grid every time step. There is no unit
@@ -160,14 +1026,28 @@ class SimpleSink:
         sim.entities[name] = self
         self.grid   = sim.grids[grid]
         self.power = power
-        self.powers = { self.grid.name : [] }
+        self.powers = { self.grid.name : array('d') }
         self.grid.powers[self.name] = self.powers[self.grid.name]
+        self.compile()
+
+    def compile(self):
+        """ Pre-resolves the series the entity writes to, see
+        Simulation.compile().
+        """
+        self.output = self.powers[self.grid.name]
 
     def step(self):
-        self.powers[self.grid.name].append(-self.power)
+        self.output.append(-self.power)
+
+    def fill(self, start, stop, offset=0):
+        self.output[start:stop] = -self.power
 
 
 class TimevariantSink:
+    __slots__ = ('name', 'grid', 'drain', 'powers', 'output', 'offset')
+    parameters = ()
+    profiles = ('drain',)
+
     def __init__(self, name, sim, grid, drain):
         """ TimevariantSink takes a list or tuple of data as input,
         and appends the appropriate time step to its power output
@@ -177,14 +1057,33 @@ class TimevariantSink:
         sim.entities[name] = self
         self.grid   = sim.grids[grid]
         self.drain = drain
-        self.powers = { self.grid.name : [] }
+        self.powers = { self.grid.name : array('d') }
         self.grid.powers[self.name] = self.powers[self.grid.name]
+        self.compile()
+
+    def compile(self):
+        """ Pre-resolves the series the entity writes to, and the
+        number of time steps dropped from its beginning, see
+        Simulation.compile() and Simulation.stream().
+        """
+        self.output = self.powers[self.grid.name]
+        self.offset = self.grid.sim.offset
 
     def step(self):
-        self.powers[self.grid.name].append(-self.drain[len(self.powers[self.grid.name])])
+        self.output.append(-self.drain[self.offset + len(self.output)])
+
+    def fill(self, start, stop, offset=0):
+        """ Fills the output from start to stop, offset is the number
+        of time steps dropped from the output's beginning, see
+        Simulation.stream().
+        """
+        self.output[start:stop] = -_window(self.drain, offset+start, offset+stop, self.output.ndim)
 
 
 class SimpleStorage:
+    __slots__ = ('name', 'grid', 'capacity', 'charges', 'initialCharge', 'charge', 'powers', 'output', 'balance')
+    parameters = ('capacity', 'initialCharge')
+
     def __init__(self, name, sim, grid, capacity, initialCharge):
         """SimpleStorage is the simplest possible storage. There is no
         over-time losses, no charging or discharging losses, and no
@@ -194,10 +1093,19 @@ class SimpleStorage:
         sim.storages[name] = self
         self.grid = sim.grids[grid]
         self.capacity = capacity
-        self.charges = []
+        self.charges = array('d')
         self.initialCharge = initialCharge
-        self.powers = { self.grid.name : [] }
+        self.charge = initialCharge
+        self.powers = { self.grid.name : array('d') }
         self.grid.powers[self.name] = self.powers[self.grid.name]
+        self.compile()
+
+    def compile(self):
+        """ Pre-resolves the series the storage writes to, see
+        Simulation.compile().
+        """
+        self.output = self.powers[self.grid.name]
+        self.balance = self.grid.powers[self.grid.name]
 
     def step(self):
         """ Step the storage. Storages are tricky to step since they
@@ -209,72 +1117,119 @@ class SimpleStorage:
             self.charges.append(self.initialCharge)
         else:
             self.charges.append(self.charges[-1])
-        if self.charges[-1] + self.grid.powers[self.grid.name][-1] > self.capacity:
+        if self.charges[-1] + self.balance[-1] > self.capacity:
             # Storage is overflowing
-            self.powers[self.grid.name].append(self.capacity - self.charges[-1])
-            self.grid.powers[self.grid.name][-1] -= self.powers[self.grid.name][-1]
+            self.output.append(self.capacity - self.charges[-1])
+            self.balance[-1] -= self.output[-1]
             self.charges[-1] = self.capacity
-        elif self.charges[-1] + self.grid.powers[self.grid.name][-1] < 0:
+        elif self.charges[-1] + self.balance[-1] < 0:
             # Storage is emptied
-            self.powers[self.grid.name].append(self.charges[-1])
-            self.grid.powers[self.grid.name][-1] += self.powers[self.grid.name][-1]
+            self.output.append(self.charges[-1])
+            self.balance[-1] += self.output[-1]
             self.charges[-1] = 0
         else:
             # Storage is used normally
-            self.powers[self.grid.name].append(-self.grid.powers[self.grid.name][-1])
-            self.grid.powers[self.grid.name][-1] = 0
-            self.charges[-1] -= self.powers[self.grid.name][-1]
+            self.output.append(-self.balance[-1])
+            self.balance[-1] = 0
+            self.charges[-1] -= self.output[-1]
+        self.charge = self.charges[-1]
+
+    def step_at(self, t):
+        """ Steps the storage at time step t of preallocated series,
+        see Simulation.run().
+        """
+        charge = self.initialCharge if t == 0 else self.charges[t-1]
+        self.charge = _dispatch_at(self, t, charge)
+
+    def dispatch(self, start, stop):
+        """ Dispatches the storage from time step start to stop in one
+        call of dispatch_storage(), see Simulation.run().
+        """
+        charge = self.initialCharge if start == 0 else self.charges[start-1]
+        self.charge = _dispatch(self, start, stop, charge, 0)
 
     def soc(self):
-        if self.charges:
-            return self.charges[-1]/self.capacity
-        else:
-            return self.initialCharge/self.capacity
+        return self.charge/self.capacity
 
 class Battery:
+    __slots__ = ('name', 'grid', 'capacity', 'charges', 'initialCharge', 'charge', 'selfDischargeRate', 'powers', 'output', 'balance')
+    parameters = ('capacity', 'initialCharge', 'selfDischargeRate')
+
     def __init__(self, name, sim, grid, capacity, initialCharge, selfDischargeRate = 0.03):
         self.name = name
         sim.storages[name] = self
         self.grid = sim.grids[grid]
         self.capacity = capacity
-        self.charges = []
+        self.charges = array('d')
         self.initialCharge = initialCharge
+        self.charge = initialCharge
         self.selfDischargeRate = selfDischargeRate
-        self.powers = { self.grid.name : [] }
+        self.powers = { self.grid.name : array('d') }
         self.grid.powers[self.name] = self.powers[self.grid.name]
+        self.compile()
+
+    def compile(self):
+        """ Pre-resolves the series the storage writes to, see
+        Simulation.compile().
+        """
+        self.output = self.powers[self.grid.name]
+        self.balance = self.grid.powers[self.grid.name]
 
     def step(self):
         if not self.charges:
             self.charges.append(self.initialCharge)
         else:
             self.charges.append(self.charges[-1] - self.selfDischargeRate*self.capacity)
-        if self.charges[-1] + self.grid.powers[self.grid.name][-1] > self.capacity:
+        if self.charges[-1] + self.balance[-1] > self.capacity:
             # Storage is overflowing
-            self.powers[self.grid.name].append(self.capacity - self.charges[-1])
-            self.grid.powers[self.grid.name][-1] -= self.powers[self.grid.name][-1]
+            self.output.append(self.capacity - self.charges[-1])
+            self.balance[-1] -= self.output[-1]
             self.charges[-1] = self.capacity
-        elif self.charges[-1] + self.grid.powers[self.grid.name][-1] < 0:
+        elif self.charges[-1] + self.balance[-1] < 0:
             # Storage is emptied
-            self.powers[self.grid.name].append(self.charges[-1])
-            self.grid.powers[self.grid.name][-1] += self.powers[self.grid.name][-1]
+            self.output.append(self.charges[-1])
+            self.balance[-1] += self.output[-1]
             self.charges[-1] = 0
         else:
             # Storage is used normally
-            self.powers[self.grid.name].append(-self.grid.powers[self.grid.name][-1])
-            self.grid.powers[self.grid.name][-1] = 0
-            self.charges[-1] -= self.powers[self.grid.name][-1]
+            self.output.append(-self.balance[-1])
+            self.balance[-1] = 0
+            self.charges[-1] -= self.output[-1]
+        self.charge = self.charges[-1]
 
-    def soc(self):
-        if self.charges:
-            return self.charges[-1]/self.capacity
+    def step_at(self, t):
+        """ Steps the battery at time step t of preallocated series,
+        see Simulation.run().
+        """
+        if t == 0:
+            charge = self.initialCharge
+        else:
+            charge = self.charges[t-1] - self.selfDischargeRate*self.capacity*self.grid.rate
+        self.charge = _dispatch_at(self, t, charge)
+
+    def dispatch(self, start, stop):
+        """ Dispatches the battery from time step start to stop in one
+        call of dispatch_storage(), see Simulation.run().
+        """
+        selfDischarge = self.selfDischargeRate*self.capacity*self.grid.rate
+        if start == 0:
+            charge = self.initialCharge
         else:
-            return self.initialCharge/self.capacity
+            charge = self.charges[start-1] - selfDischarge
+        self.charge = _dispatch(self, start, stop, charge, selfDischarge)
+
+    def soc(self):
+        return self.charge/self.capacity
 
 
 class RegulatedSource:
+    __slots__ = ('name', 'grid', 'power', 'regulator', 'signal', 'powers', 'rate', 'output')
+    parameters = ('power',)
+
     def __init__(self, name, sim, grid, power, regulator, signal):
         """ RegulatedSource is a source that varies according to its
-        regulator between 0 and self.power power output.
+        regulator between 0 and self.power power output. It steps at the
+        rate of its grid, or at that of the storage its signal reads.
         """
         self.name = name
         sim.entities[name] = self
@@ -282,17 +1237,41 @@ class RegulatedSource:
         self.power = power
         self.regulator = regulator
         self.signal = signal
-        self.powers = { self.grid.name : [] }
+        self.powers = { self.grid.name : array('d') }
         self.grid.powers[self.name] = self.powers[self.grid.name]
+        self.compile()
+
+    def compile(self):
+        """ Pre-resolves the series the entity writes to, see
+        Simulation.compile().
+        """
+        self.rate = _rate(self.signal, [self.grid])
+        self.output = _port(self.powers[self.grid.name], self.grid.rate, self.rate)
 
     def step(self):
         if self.signal:
-            self.powers[self.grid.name].append(self.power*self.regulator.step(self.signal))
+            self.output.append(self.power*self.regulator.step(self.signal))
         else:
-            self.powers[self.grid.name].append(0)
+            self.output.append(0)
+
+    def step_at(self, t):
+        if self.signal:
+            self.output[t] = self.power*self.regulator.step_at(t, self.signal)
+        else:
+            self.output[t] = 0
+
+    def factors(self):
+        """ Returns the power on every grid per unit of regulator
+        output, see Simulation.incidence().
+        """
+        return { self.grid.name: self.power }
 
 
 class SimpleSolar:
+    __slots__ = ('name', 'grid', 'irradiance', 'efficiency', 'area', 'powers', 'output', 'offset')
+    parameters = ('efficiency', 'area')
+    profiles = ('irradiance',)
+
     def __init__(self, name, sim, grid, irradiance, efficiency, area):
         """ Creates a SimpleSolar power source, taking irradiance data
         given in [W/m^2], efficiency in absolute numbers, and area in
@@ -304,14 +1283,33 @@ class SimpleSolar:
         self.irradiance = irradiance
         self.efficiency = efficiency
         self.area = area
-        self.powers = { self.grid.name: [] }
+        self.powers = { self.grid.name: array('d') }
         self.grid.powers[self.name] = self.powers[self.grid.name]
+        self.compile()
+
+    def compile(self):
+        """ Pre-resolves the series the entity writes to, and the
+        number of time steps dropped from its beginning, see
+        Simulation.compile() and Simulation.stream().
+        """
+        self.output = self.powers[self.grid.name]
+        self.offset = self.grid.sim.offset
 
     def step(self):
-        self.powers[self.grid.name].append(self.irradiance[len(self.powers[self.grid.name])] * self.efficiency * self.area)
+        self.output.append(self.irradiance[self.offset + len(self.output)] * self.efficiency * self.area)
+
+    def fill(self, start, stop, offset=0):
+        """ Fills the output from start to stop, offset is the number
+        of time steps dropped from the output's beginning, see
+        Simulation.stream().
+        """
+        self.output[start:stop] = _window(self.irradiance, offset+start, offset+stop, self.output.ndim) * self.efficiency * self.area
 
 
 class SimpleBoiler:
+    __slots__ = ('name', 'fuelGrid', 'heatGrid', 'powers', 'regulator', 'signal', 'thermalRatedPower', 'fuelUse', 'rate', 'fuelOutput', 'heatOutput')
+    parameters = ('thermalRatedPower', 'fuelUse')
+
     def __init__( self
                 , name
                 , sim
@@ -325,8 +1323,8 @@ class SimpleBoiler:
         sim.entities[name] = self
         self.fuelGrid = sim.grids[fuelGrid]
         self.heatGrid = sim.grids[heatGrid]
-        self.powers = { self.fuelGrid.name : []
-                      , self.heatGrid.name : []
+        self.powers = { self.fuelGrid.name : array('d')
+                      , self.heatGrid.name : array('d')
                       }
         self.fuelGrid.powers[self.name] = self.powers[self.fuelGrid.name]
         self.heatGrid.powers[self.name] = self.powers[self.heatGrid.name]
@@ -334,16 +1332,47 @@ class SimpleBoiler:
         self.signal = signal
         self.thermalRatedPower = thermalRatedPower
         self.fuelUse = fuelUse
+        self.compile()
+
+    def compile(self):
+        """ Pre-resolves the series the boiler writes to, see
+        Simulation.compile(). The boiler steps at the rate of the
+        storage its signal reads, or of its fastest grid.
+        """
+        self.rate = _rate(self.signal, [self.fuelGrid, self.heatGrid])
+        self.fuelOutput = _port(self.powers[self.fuelGrid.name], self.fuelGrid.rate, self.rate)
+        self.heatOutput = _port(self.powers[self.heatGrid.name], self.heatGrid.rate, self.rate)
 
     def step(self):
         if self.signal:
             reg = self.regulator.step(self.signal)
         else:
             reg = 0
-        self.powers[self.fuelGrid.name].append(-reg*self.fuelUse)
-        self.powers[self.heatGrid.name].append(reg*self.thermalRatedPower)
+        self.fuelOutput.append(-reg*self.fuelUse)
+        self.heatOutput.append(reg*self.thermalRatedPower)
+
+    def step_at(self, t):
+        if self.signal:
+            reg = self.regulator.step_at(t, self.signal)
+        else:
+            reg = 0
+        self.fuelOutput[t] = -reg*self.fuelUse
+        self.heatOutput[t] = reg*self.thermalRatedPower
+
+    def factors(self):
+        """ Returns the power on every grid per unit of regulator
+        output, see Simulation.incidence().
+        """
+        return { self.fuelGrid.name: -self.fuelUse
+               , self.heatGrid.name: self.thermalRatedPower
+               }
 
 class CHPboiler:
+    __slots__ = ( 'name', 'fuelGrid', 'heatGrid', 'electricityGrid', 'powers', 'regulator', 'signal'
+                , 'thermalRatedPower', 'electricityRatedPower', 'fuelUse', 'rate'
+                , 'fuelOutput', 'heatOutput', 'electricityOutput' )
+    parameters = ('thermalRatedPower', 'electricityRatedPower', 'fuelUse')
+
     def __init__(self
                 , name
                 , sim
@@ -360,9 +1389,9 @@ class CHPboiler:
         self.fuelGrid = sim.grids[fuelGrid]
         self.heatGrid = sim.grids[heatGrid]
         self.electricityGrid = sim.grids[electricityGrid]
-        self.powers = { self.fuelGrid.name : []
-                      , self.heatGrid.name : []
-                      , self.electricityGrid.name : []
+        self.powers = { self.fuelGrid.name : array('d')
+                      , self.heatGrid.name : array('d')
+                      , self.electricityGrid.name : array('d')
                       }
         self.fuelGrid.powers[self.name] = self.powers[self.fuelGrid.name]
         self.heatGrid.powers[self.name] = self.powers[self.heatGrid.name]
@@ -372,18 +1401,50 @@ class CHPboiler:
         self.thermalRatedPower = thermalRatedPower
         self.electricityRatedPower = electricityRatedPower
         self.fuelUse = fuelUse
+        self.compile()
+
+    def compile(self):
+        """ Pre-resolves the series the boiler writes to, see
+        Simulation.compile(). The boiler steps at the rate of the
+        storage its signal reads, or of its fastest grid.
+        """
+        self.rate = _rate(self.signal, [self.fuelGrid, self.heatGrid, self.electricityGrid])
+        self.fuelOutput = _port(self.powers[self.fuelGrid.name], self.fuelGrid.rate, self.rate)
+        self.heatOutput = _port(self.powers[self.heatGrid.name], self.heatGrid.rate, self.rate)
+        self.electricityOutput = _port(self.powers[self.electricityGrid.name], self.electricityGrid.rate, self.rate)
 
     def step(self):
         if self.signal:
             reg = self.regulator.step(self.signal)
         else:
             reg = 0
-        self.powers[self.fuelGrid.name].append(reg*self.fuelUse)
-        self.powers[self.heatGrid.name].append(reg*self.thermalRatedPower)
-        self.powers[self.electricityGrid.name].append(reg*self.electricityRatedPower)
+        self.fuelOutput.append(reg*self.fuelUse)
+        self.heatOutput.append(reg*self.thermalRatedPower)
+        self.electricityOutput.append(reg*self.electricityRatedPower)
+
+    def step_at(self, t):
+        if self.signal:
+            reg = self.regulator.step_at(t, self.signal)
+        else:
+            reg = 0
+        self.fuelOutput[t] = reg*self.fuelUse
+        self.heatOutput[t] = reg*self.thermalRatedPower
+        self.electricityOutput[t] = reg*self.electricityRatedPower
+
+    def factors(self):
+        """ Returns the power on every grid per unit of regulator
+        output, see Simulation.incidence().
+        """
+        return { self.fuelGrid.name: self.fuelUse
+               , self.heatGrid.name: self.thermalRatedPower
+               , self.electricityGrid.name: self.electricityRatedPower
+               }
 
 
 class OnoffRegulator:
+    __slots__ = ('onThr', 'offThr', 'states', 'initState', 'flip')
+    parameters = ('onThr', 'offThr', 'initState')
+
     def __init__(self, onThr, offThr, initState, flip=0):
         """ Simplest possible regulator there is, an on/off regulator.
         onThr is the low point where the regulator turns on, offThr
@@ -392,7 +1453,7 @@ class OnoffRegulator:
         """
         self.onThr = onThr
         self.offThr = offThr
-        self.states = []
+        self.states = array('b')
         self.initState = initState
         self.flip = flip
 
@@ -422,44 +1483,612 @@ class OnoffRegulator:
         else:
             return self.states[-1]
 
+    def step_at(self, t, signal):
+        """ Steps the regulator at time step t of a preallocated states
+        array, see Simulation.run().
+        """
+        if t == 0:
+            state = self.initState
+        elif isinstance(self.states[t-1], np.ndarray):
+            # Batched scenarios, see Simulation.scenarios()
+            level = signal()
+            state = np.where( self.states[t-1] == 1
+                            , np.where(level > self.offThr, 0, 1)
+                            , np.where(level < self.onThr, 1, 0) )
+        elif self.states[t-1] == 1:
+            state = 0 if signal() > self.offThr else 1
+        else:
+            state = 1 if signal() < self.onThr else 0
+        self.states[t] = state
+        if self.flip:
+            return 1-state
+        else:
+            return state
+
+class Incidence:
+    def __init__(self, rows, columns, entries):
+        """ A sparse incidence matrix of entities and grids, see
+        Simulation.incidence(). rows are (entity name, grid name or
+        None) pairs, columns grid names, and entries (row, column,
+        factor) triplets. The matrix is stored by column, like a
+        scipy.sparse CSC matrix, in indptr, indices and data.
+        """
+        self.rows = rows
+        self.columns = columns
+        entries = sorted(entries, key=lambda entry: (entry[1], entry[0]))
+        self.indices = np.array([ row for row, _, _ in entries ], dtype=np.intp)
+        self.data = np.array([ factor for _, _, factor in entries ], dtype=np.float64)
+        columnof = np.array([ column for _, column, _ in entries ], dtype=np.intp)
+        self.indptr = np.searchsorted(columnof, np.arange(len(columns) + 1))
+
+    def entries(self):
+        """ Returns the matrix as a list of (row, column, factor)
+        triplets.
+        """
+        return [ (int(row), column, float(factor))
+                 for column in range(len(self.columns))
+                 for row, factor in zip( self.indices[self.indptr[column]:self.indptr[column+1]]
+                                       , self.data[self.indptr[column]:self.indptr[column+1]] ) ]
+
+    def select(self, rows, columns):
+        """ Returns the submatrix of the given row and column indices.
+        """
+        rowmap = { row: i for i, row in enumerate(rows) }
+        columnmap = { column: j for j, column in enumerate(columns) }
+        return Incidence( [ self.rows[i] for i in rows ]
+                        , [ self.columns[j] for j in columns ]
+                        , [ (rowmap[row], columnmap[column], factor) for row, column, factor in self.entries()
+                            if row in rowmap and column in columnmap ] )
+
+    def product(self, activities):
+        """ Returns activities, a (steps, rows) array, times the matrix:
+        a (steps, columns) array with the sum of every column's
+        entries, each weighted by the activity of its row.
+        """
+        activities = np.asarray(activities, dtype=np.float64)
+        result = np.zeros((len(activities), len(self.columns)))
+        if len(self.data):
+            contributions = activities[:, self.indices]*self.data
+            starts = self.indptr[:-1]
+            filled = starts < self.indptr[1:]
+            result[:, filled] = np.add.reduceat(contributions, starts[filled], axis=1)
+        return result
+
+    def tosparse(self):
+        """ Returns the matrix as a scipy.sparse CSC array.
+        """
+        from scipy import sparse
+        return sparse.csc_array((self.data, self.indices, self.indptr), shape=(len(self.rows), len(self.columns)))
+
+
+_module_digest = []
+
+def _source_digest():
+    """ Returns a digest of this module's source, so results cached by
+    an older version are never used, see Simulation.fingerprint().
+    """
+    if not _module_digest:
+        with open(__file__, 'rb') as f:
+            _module_digest.append(hashlib.sha256(f.read()).digest())
+    return _module_digest[0]
+
+def _source(obj):
+    """ Returns the source of a class or function, see
+    Simulation.fingerprint(). Raises a ValueError if it isn't available.
+    """
+    try:
+        return inspect.getsource(obj)
+    except (OSError, TypeError):
+        raise ValueError(f"can't fingerprint {obj.__qualname__}, its source is not available")
+
+def _attributes(obj):
+    """ Returns (name, value) pairs of every attribute of obj, those
+    in the __slots__ of its classes and those in its __dict__.
+    """
+    names = []
+    for cls in reversed(type(obj).__mro__):
+        slots = cls.__dict__.get('__slots__', ())
+        names += [ slots ] if isinstance(slots, str) else list(slots)
+    attributes = [ (name, getattr(obj, name)) for name in names
+                   if name not in ('__dict__', '__weakref__') and hasattr(obj, name) ]
+    return attributes + list(getattr(obj, '__dict__', {}).items())
+
+def _digest(h, value):
+    """ Feeds value to the hash h: a number, string, date, time
+    difference or None, an array or a sequence of numbers, or a tuple or
+    list of such values.
+    """
+    if isinstance(value, np.generic):
+        value = value.item()
+    if value is None or isinstance(value, (bool, int, float, str, datetime, timedelta)):
+        h.update(f"{type(value).__name__}:{value!r};".encode())
+    elif isinstance(value, (list, tuple)) and not all(isinstance(v, (int, float, np.number)) for v in value):
+        h.update(f"{type(value).__name__}{len(value)}(".encode())
+        for v in value:
+            _digest(h, v)
+        h.update(b");")
+    elif isinstance(value, (np.ndarray, array, list, tuple)):
+        try:
+            data = np.ascontiguousarray(value, dtype=np.float64)
+        except TypeError:
+            raise ValueError(f"can't fingerprint arrays of {np.asarray(value).dtype}")
+        h.update(f"array{data.shape};".encode())
+        h.update(data)
+    else:
+        raise ValueError(f"can't fingerprint {type(value).__name__} values")
+
+
+def _buffer(series, dtype):
+    """ Returns a copy of a numpy series as an array.array, 'd' for
+    float series and 'b' for regulator states. Typed arrays index about
+    as fast as lists, but store unboxed values.
+    """
+    buffer = array('d' if dtype == np.float64 else 'b')
+    buffer.frombytes(series.astype(np.float64 if dtype == np.float64 else np.int8).tobytes())
+    return buffer
+
+def _preallocate(series, shape, dtype=np.float64):
+    """ Returns a zeroed numpy array of the given shape with the
+    already simulated values of series copied into its beginning.
+    """
+    output = np.zeros(shape, dtype=dtype)
+    output[:len(series)] = np.reshape(series, np.shape(series) + (1,)*(len(shape) - np.ndim(series)))
+    return output
+
+def _rate(signal, grids):
+    """ Returns the rate a regulated entity steps at: that of the grid
+    of the storage its signal reads, or else that of its fastest grid.
+    """
+    storage = getattr(signal, '__self__', None)
+    if hasattr(storage, 'grid'):
+        return storage.grid.rate
+    return min(g.rate for g in grids)
+
+def _port(series, gridRate, rate):
+    """ Returns the series an entity stepping every rate time steps
+    writes to for a grid stepping every gridRate time steps: the
+    series itself if the rates are the same, and otherwise an adapter
+    averaging the entity's values over the grid step, or holding them
+    over several grid steps.
+    """
+    if gridRate == rate:
+        return series
+    if gridRate % rate == 0:
+        return _Averaged(series, gridRate // rate)
+    if rate % gridRate == 0:
+        return _Held(series, rate // gridRate)
+    raise ValueError(f"grid rate {gridRate} and entity rate {rate} must be multiples of each other")
+
+class _Averaged:
+    """ Writes every value as 1/n of the grid step it falls in. The
+    steps of the grid series must start out zeroed, like run()
+    preallocates them.
+    """
+    def __init__(self, series, n):
+        self.series = series
+        self.n = n
+
+    def __setitem__(self, t, value):
+        self.series[t // self.n] += value/self.n
+
+class _Held:
+    """ Writes every value to n consecutive grid steps.
+    """
+    def __init__(self, series, n):
+        self.series = series
+        self.n = n
+
+    def __setitem__(self, t, value):
+        for i in range(t*self.n, (t+1)*self.n):
+            self.series[i] = value
+
+def _window(data, start, stop, ndim=1):
+    """ Returns data[start:stop] as a float64 array with at least
+    ndim dimensions, so that one-dimensional data broadcasts over
+    batched scenarios. Raises an IndexError, like stepping past the end
+    of the data would, if data is too short.
+    """
+    if len(data) < stop:
+        raise IndexError(f"data has {len(data)} values, {stop} needed")
+    window = np.asarray(data[start:stop], dtype=np.float64)
+    return window.reshape(window.shape + (1,)*(ndim - window.ndim))
+
+def _dispatch_at(storage, t, charge):
+    """ Applies the overflow/empty/normal clamp of a storage holding
+    charge at time step t, updating the storage's power, its grid's
+    balance and its charges. Returns the new charge.
+    """
+    balance = storage.balance
+    power = storage.output
+    rate = storage.grid.rate
+    if rate != 1:
+        # A step of a slow grid holds mean powers over rate time steps,
+        # so the storage clamps the energy of the whole step.
+        balance[t] *= rate
+        charge = _clamp_at(storage, t, charge)
+        balance[t] /= rate
+        power[t] /= rate
+        return charge
+    return _clamp_at(storage, t, charge)
+
+def _clamp_at(storage, t, charge):
+    """ The clamp of _dispatch_at(), for a storage on a grid
+    stepping every time step.
+    """
+    balance = storage.balance
+    power = storage.output
+    if isinstance(balance[t], np.ndarray):
+        # Batched scenarios, see Simulation.scenarios()
+        power[t], balance[t], charge = _clamp(charge, balance[t], storage.capacity)
+    elif charge + balance[t] > storage.capacity:
+        # Storage is overflowing
+        power[t] = storage.capacity - charge
+        balance[t] -= power[t]
+        charge = storage.capacity
+    elif charge + balance[t] < 0:
+        # Storage is emptied
+        power[t] = charge
+        balance[t] += power[t]
+        charge = 0
+    else:
+        # Storage is used normally
+        power[t] = -balance[t]
+        balance[t] = 0
+        charge -= power[t]
+    storage.charges[t] = charge
+    return charge
+
+def _leading(condition):
+    """ Returns the number of leading True values in condition.
+    """
+    return len(condition) if condition.all() else int(np.argmin(condition))
+
+def _leap_storage(balance, charge, capacity, selfDischarge):
+    """ Computes a storage holding charge over the grid balances in
+    balance for as long as it stays in the same state: overflowing,
+    emptied or used normally. Returns the charges, storage power and
+    residual balance of those steps, the same as stepping would give.
+    """
+    if charge == capacity:
+        decayed = capacity - selfDischarge
+        n = _leading(decayed + balance > capacity)
+        if n:
+            power = capacity - decayed
+            return np.full(n, capacity, dtype=np.float64), np.full(n, power), balance[:n] - power
+    elif charge == 0:
+        decayed = 0 - selfDischarge
+        n = _leading(decayed + balance < 0)
+        if n:
+            return np.zeros(n), np.full(n, decayed, dtype=np.float64), balance[:n] + decayed
+    # Normal use is a running sum; accumulating the self-discharge and
+    # the balances in stepping order makes it exact.
+    sequence = np.empty(2*len(balance) + 1)
+    sequence[0] = charge
+    sequence[1::2] = -selfDischarge
+    sequence[2::2] = balance
+    charges = np.add.accumulate(sequence)[2::2]
+    n = _leading((charges >= 0) & (charges <= capacity))
+    return charges[:n], -balance[:n], np.zeros(n)
+
+def _dispatch(storage, start, stop, charge, selfDischarge):
+    """ Runs dispatch_storage() for a storage from time step start to
+    stop and writes the results into its preallocated series. Returns
+    the final charge.
+    """
+    balance = storage.balance
+    rate = storage.grid.rate
+    if rate != 1:
+        # See _dispatch_at()
+        charges, power, residual = dispatch_storage(balance[start:stop]*rate, storage.capacity, charge, selfDischarge)
+        power, residual = power/rate, residual/rate
+    else:
+        charges, power, residual = dispatch_storage(balance[start:stop], storage.capacity, charge, selfDischarge)
+    storage.charges[start:stop] = charges
+    storage.output[start:stop] = power
+    balance[start:stop] = residual
+    return storage.charges[stop-1] if stop > start else charge
+
+def dispatch_storage(balance, capacity, charge, selfDischarge=0):
+    """ Storage dispatch kernel. Runs the overflow/empty/normal clamp
+    of a storage over a whole array of grid balances in one call,
+    giving the same results as stepping the storage. charge is the
+    charge going into the first step, and selfDischarge is subtracted
+    from the charge before every following step.
+
+    Returns three float64 arrays: the charge after every step, the
+    storage power and the residual grid balance.
+    """
+    balance = np.asarray(balance, dtype=np.float64)
+    if balance.ndim > 1 or np.ndim(capacity) or np.ndim(charge) or np.ndim(selfDischarge):
+        return _dispatch_batched(balance, capacity, charge, selfDischarge)
+    n = len(balance)
+    values = balance.tolist()
+    charges = np.empty(n)
+    powers = np.empty(n)
+    residual = np.empty(n)
+    # Stretches where the storage stays overflowing, emptied or in normal
+    # use are computed as whole arrays by _leap_storage(), over a window
+    # growing while the stretches fill it. The first step and the steps
+    # where the state changes are clamped one by one, below, and so are
+    # a few steps after short stretches, which are cheaper to step.
+    window = 64
+    stepped = 1
+    t = 0
+    while t < n:
+        if not stepped:
+            size = min(window, n - t)
+            leap = _leap_storage(balance[t:t+size], charge, capacity, selfDischarge)
+            k = len(leap[0])
+            if k:
+                charges[t:t+k], powers[t:t+k], residual[t:t+k] = leap
+                charge = float(charges[t+k-1])
+                t += k
+            if k == size:
+                window = min(2*window, 65536)
+                continue
+            window = max(64, 2*k)
+            stepped = 1 if k >= 16 else 32
+        if t:
+            charge -= selfDischarge
+        b = values[t]
+        if charge + b > capacity:
+            # Storage is overflowing
+            power = capacity - charge
+            residual[t] = b - power
+            charge = capacity
+        elif charge + b < 0:
+            # Storage is emptied
+            power = charge
+            residual[t] = b + power
+            charge = 0
+        else:
+            # Storage is used normally
+            power = -b
+            residual[t] = 0
+            charge -= power
+        charges[t] = charge
+        powers[t] = power
+        t += 1
+        stepped -= 1
+    return charges, powers, residual
+
+def _dispatch_batched(balance, capacity, charge, selfDischarge):
+    """ dispatch_storage() for batched scenarios, stepping whole rows
+    of (steps, scenarios) arrays.
+    """
+    shape = np.broadcast_shapes(balance.shape, (1,) + np.shape(capacity), (1,) + np.shape(charge))
+    charges = np.zeros(shape)
+    powers = np.zeros(shape)
+    residual = np.zeros(shape)
+    for t in range(shape[0]):
+        if t:
+            charge = charge - selfDischarge
+        powers[t], residual[t], charge = _clamp(charge, balance[t], capacity)
+        charges[t] = charge
+    return charges, powers, residual
+
+def _clamp(charge, balance, capacity):
+    """ The overflow/empty/normal storage clamp, vectorized over
+    batched scenarios. Returns the storage power, the residual grid
+    balance and the new charge.
+    """
+    overflow = charge + balance > capacity
+    empty = ~overflow & (charge + balance < 0)
+    power = np.where(overflow, capacity - charge, np.where(empty, charge, -balance))
+    residual = np.where(overflow, balance - power, np.where(empty, balance + power, 0))
+    charge = np.where(overflow, capacity, np.where(empty, 0, charge - power))
+    return power, residual, charge
+
+## STREAMING REDUCERS
+#
+# Reducers summarize a series chunk by chunk, see
+# Simulation.add_reducer() and Simulation.stream(). Every reducer has an
+# update(chunk) method and keeps its result in self.value. Batched
+# scenarios are reduced per scenario.
+
+class Sum:
+    def __init__(self, scale=1):
+        """ Sums a series and multiplies it by scale, e.g. the time
+        step in hours to get energy from power.
+        """
+        self.scale = scale
+        self.value = 0
+
+    def update(self, chunk):
+        self.value = self.value + np.sum(chunk, axis=0)*self.scale
+
+
+class Minimum:
+    def __init__(self):
+        self.value = None
+
+    def update(self, chunk):
+        if len(chunk):
+            low = np.min(chunk, axis=0)
+            self.value = low if self.value is None else np.minimum(self.value, low)
+
+
+class Maximum:
+    def __init__(self):
+        self.value = None
+
+    def update(self, chunk):
+        if len(chunk):
+            high = np.max(chunk, axis=0)
+            self.value = high if self.value is None else np.maximum(self.value, high)
+
+
+class Histogram:
+    def __init__(self, bins):
+        """ Counts the values of a series falling between the bin edges
+        in bins.
+        """
+        self.bins = np.asarray(bins, dtype=np.float64)
+        self.value = 0
+
+    def update(self, chunk):
+        chunk = np.asarray(chunk)
+        if chunk.ndim > 1:
+            counts = np.stack([ np.histogram(c, self.bins)[0] for c in chunk.T ], axis=1)
+        else:
+            counts = np.histogram(chunk, self.bins)[0]
+        self.value = self.value + counts
+
+
+class Starts:
+    def __init__(self, before=0, after=1):
+        """ Counts the times a series goes from before to after, e.g.
+        the starts of a regulator when reducing its states.
+        """
+        self.before = before
+        self.after = after
+        self.last = None
+        self.value = 0
+
+    def update(self, chunk):
+        chunk = np.asarray(chunk)
+        if self.last is not None:
+            chunk = np.concatenate((self.last[np.newaxis], chunk))
+        if len(chunk):
+            self.value = self.value + np.sum((chunk[:-1] == self.before) & (chunk[1:] == self.after), axis=0)
+            self.last = chunk[-1]
+
+
+class Stops(Starts):
+    def __init__(self):
+        """ Counts the times a 0/1 series goes from 1 to 0.
+        """
+        super().__init__(1, 0)
+
+
+class Shortfall:
+    def __init__(self, scale=1):
+        """ Sums the negative part of a series as a positive number and
+        multiplies it by scale, e.g. the demand a grid balance left
+        unmet when its storages were empty.
+        """
+        self.scale = scale
+        self.value = 0
+
+    def update(self, chunk):
+        self.value = self.value - np.sum(np.minimum(chunk, 0), axis=0)*self.scale
+
+
+class RunTime:
+    def __init__(self, scale=1):
+        """ Counts the time steps a series is non-zero, multiplied by
+        scale, e.g. the time step in hours to get running hours.
+        """
+        self.scale = scale
+        self.value = 0
+
+    def update(self, chunk):
+        self.value = self.value + np.count_nonzero(chunk, axis=0)*self.scale
+
 ## STANDARD DATA MANIPULATORS
 #
 # These are some standard functions to manipulate data into different
 # resolutions. Some of them might be destructive - be careful.
-def increase_resolution(data, magnifier):
-    output = []
-    for d in data:
-        for _ in range(magnifier):
-            output.append(d/magnifier)
+#
+# resample() does any conversion in one pass, placing the data on a
+# real calendar. The fixed conversions below are kept as shorthands.
+
+SIX_MINUTES = timedelta(minutes=6)
+HOUR = timedelta(hours=1)
+DAY = timedelta(days=1)
+WEEK = timedelta(weeks=1)
+# A non-leap year, so that a year of data is 365 days unless a start
+# date is given.
+DEFAULT_START = datetime(2001, 1, 1)
+
+def resample(data, source, target, how='sum', start=None):
+    """ Resamples data from the resolution source to the resolution
+    target. Resolutions are datetime.timedelta objects, 'month' or
+    'year'. The data is placed on a real calendar beginning at start
+    (a datetime, DEFAULT_START if not given), so months and years get
+    their real lengths, leap years included.
+
+    how='sum' treats the values as amounts per time step, like energy:
+    they are split evenly when the resolution increases and summed when
+    it decreases, keeping the total. how='mean' treats them as rates,
+    like power or irradiance: they are repeated when the resolution
+    increases and averaged over time when it decreases.
+
+    Only target time steps completely covered by data are returned.
+    """
+    if how not in ('sum', 'mean'):
+        raise ValueError(f"how must be 'sum' or 'mean', not {how!r}")
+    data = np.asarray(data, dtype=np.float64)
+    if isinstance(source, timedelta) and isinstance(target, timedelta):
+        # Whole multiples need no calendar, just a reshape
+        if target % source == timedelta(0):
+            if how == 'sum':
+                return decrease_resolution(data, target//source)
+            return decrease_resolution(data, target//source)/(target//source)
+        if source % target == timedelta(0):
+            if how == 'sum':
+                return increase_resolution(data, source//target)
+            return np.repeat(data, source//target, axis=0)
+    start = np.datetime64(start or DEFAULT_START, 's')
+    sourceEdges = _edges(start, source, count=len(data))
+    targetEdges = _edges(start, target, until=sourceEdges[-1])
+    x = (sourceEdges - start).astype(np.float64)
+    xt = (targetEdges - start).astype(np.float64)
+    amounts = data if how == 'sum' else data*np.diff(x)
+    output = np.diff(np.interp(xt, x, np.concatenate(([0], np.cumsum(amounts)))))
+    if how == 'mean':
+        output /= np.diff(xt)
     return output
 
+def _edges(start, resolution, count=None, until=None):
+    """ Returns the time step edges, as datetime64 seconds, of either
+    count time steps of the given resolution beginning at start, or of
+    as many whole time steps as fit between start and until.
+    """
+    if isinstance(resolution, timedelta):
+        step = np.timedelta64(int(resolution.total_seconds()), 's')
+        if count is None:
+            count = (until - start)//step
+        return start + step*np.arange(count + 1)
+    unit = { 'month': 'M', 'year': 'Y' }[resolution]
+    first = start.astype(f"datetime64[{unit}]")
+    if first.astype('datetime64[s]') != start:
+        raise ValueError(f"{resolution} resolution data must start at the beginning of a {resolution}")
+    if count is None:
+        count = (until.astype(f"datetime64[{unit}]") - first).astype(int)
+        if (first + count).astype('datetime64[s]') > until:
+            count -= 1
+    return (first + np.arange(count + 1)).astype('datetime64[s]')
+
+def savgol_filter(x, window_length, polyorder, **kwargs):
+    """ scipy.signal.savgol_filter(), with SciPy imported on first
+    use, since importing it takes longer than the rest of this module.
+    """
+    from scipy.signal import savgol_filter
+    return savgol_filter(x, window_length, polyorder, **kwargs)
+
+def increase_resolution(data, magnifier):
+    return np.repeat(np.asarray(data, dtype=np.float64)/magnifier, magnifier, axis=0)
+
 def decrease_resolution(data, denominator):
-    output = []
-    for i in range(len(data)//denominator):
-        output.append(sum(data[i*denominator-denominator:i*denominator]))
-    return output
+    data = np.asarray(data, dtype=np.float64)
+    n = len(data)//denominator
+    return data[:n*denominator].reshape((n, denominator) + data.shape[1:]).sum(axis=1)
 
-def monthly_to_daily(data):
+def monthly_to_daily(data, start=None):
     """ This function takes monthly data and converts it into smoothed
     daily data. To get weekly data, it is advised to go via this
     function first.
     """
-    months = [31, 28, 31, 30, 31, 30, 31, 30, 31, 31, 30, 31]
-    output =  []
-    for month, d in zip(months, data):
-        for _ in range(month):
-            output.append(d/month)
-    return output
+    return resample(data, 'month', DAY, start=start)
 
-def monthly_to_power(data):
+def monthly_to_power(data, start=None):
     """ This function takes monthly energy use and converts it to 
     monthly average power, which is beetter for some applications. 
     """
-    months = [31, 28, 31, 30, 31, 30, 31, 30, 31, 31, 30, 31]
-    output = []
-    for month, d in zip(months, data):
-        output.append(d/(month*24))
-    return output
+    start = np.datetime64(start or DEFAULT_START, 's')
+    hours = np.diff(_edges(start, 'month', count=len(data))).astype(np.float64)/3600
+    return np.asarray(data, dtype=np.float64)/hours
 
 def monthly_to_weekly(data):
     return daily_to_weekly(monthly_to_daily(data))
@@ -480,13 +2109,13 @@ def _6min_to_hourly(data):
     return decrease_resolution(data, 10)
 
 def hourly_to_daily(data):
-    return [ i/24 for i in decrease_resolution(data, 24) ]
+    return decrease_resolution(data, 24)/24
 
 def hourly_to_weekly(data):
-    return [ i/168 for i in decrease_resolution(data, 168) ]
+    return decrease_resolution(data, 168)/168
 
 def daily_to_weekly(data):
-    return [ i/7 for i in decrease_resolution(data, 7) ]
+    return decrease_resolution(data, 7)/7
 
 if __name__ == '__main__':
     pass
@@ -1,15 +1,20 @@
-import matplotlib.pyplot as plt
 import energyoptinator as eo
 import svenska_schabloner as se
+from sweep import Sweep
 
-def sim(atemp=150, hushel=6000, varme=18000, solar_efficiency=0.18, solar_area=0):
+def profiles(atemp=150, hushel=6000):
+    """ Builds the monthly input profiles for a house with atemp m² of
+    heated area, shared by every solar area tried.
+    """
     tvv = 20*atemp
-    hushel = hushel
     varme = atemp*120-tvv-hushel
-    hushel = hushel/8760
     irr = se.monthly_to_power([ 13, 24, 41, 90, 114, 108, 102, 105, 88, 90, 53, 16 ]) # kWh/m^2, month
     tvv = se.monthly_to_power(se.hemsol_tvv(tvv))
     varme = se.monthly_to_power(se.hemsol_varme(varme))
+    return { 'irr': irr, 'tvv': tvv, 'varme': varme }
+
+def build(irr, tvv, varme, hushel=6000, solar_efficiency=0.18, solar_area=0):
+    hushel = hushel/8760
     s = eo.Simulation('Solar optimizer')
     eo.Grid('Electricity', s)
     eo.Grid('Heat', s)
@@ -17,17 +22,27 @@ def sim(atemp=150, hushel=6000, varme=18000, solar_efficiency=0.18, solar_area=0
     eo.TimevariantSink('Hot water', s, 'Heat', tvv)
     eo.TimevariantSink('Space heating', s, 'Heat', varme)
     eo.SimpleSolar('Solar', s, 'Electricity', irr, solar_efficiency, solar_area)
-    for _ in range(12):
-        s.step()
+    return s
+
+def max_heatfactor(s):
     return max([ e/h for e, h in zip(s.grids['Electricity'].powers['Electricity'], s.grids['Heat'].powers['Heat']) ])
 
+def sim(atemp=150, hushel=6000, varme=18000, solar_efficiency=0.18, solar_area=0):
+    s = build(**profiles(atemp, hushel), hushel=hushel, solar_efficiency=solar_efficiency, solar_area=solar_area)
+    s.run(12)
+    return max_heatfactor(s)
+
 def plot_heatfactor():
+    import matplotlib.pyplot as plt
     atemp = 150
-    heatfactors = []
-    for a in range(int(atemp/5), atemp):
-        heatfactors.append(sim(atemp=atemp, solar_area=a))
+    sweep = Sweep( build
+                 , { 'solar_area': range(int(atemp/5), atemp) }
+                 , { 'heatfactor': max_heatfactor }
+                 , profiles=profiles(atemp)
+                 , steps=12 )
+    sweep.run()
     fig = plt.figure()
-    plt.plot(heatfactors)
+    plt.plot(sweep.column('solar_area'), sweep.column('heatfactor'))
     plt.xlabel('Solar area')
     plt.ylabel('Maximum heat factor')
     plt.show()
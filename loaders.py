@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+import os
+import numpy as np
+import energyoptinator as eo
+
+## DATA LOADERS
+#
+# Functions reading measured time series, like irradiance or load,
+# from files into arrays that TimevariantSource, TimevariantSink and
+# SimpleSolar take directly. Binary .npy files are memory mapped, so
+# even multi-year minute data is not copied until it is simulated.
+
+def load( path
+        , column = None
+        , resolution = None
+        , target = eo.SIX_MINUTES
+        , how = 'mean'
+        , steps = None
+        , start = None
+        , delimiter = None ):
+    """ Loads a time series from a .npy, .csv or .parquet file, picked
+    by the file extension. column names the column to read from CSV and
+    Parquet files, and may be left out for single column files.
+
+    If resolution, the resolution of the data in the file, is given and
+    differs from target, the data is resampled with eo.resample(), using
+    how and start. Otherwise the data is returned as is; .npy files
+    stay memory mapped.
+
+    If steps is given, the data must cover at least that many time
+    steps of the simulation, otherwise a ValueError is raised.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.npy':
+        data = load_npy(path)
+    elif extension in ('.csv', '.txt'):
+        data = load_csv(path, column, delimiter)
+    elif extension in ('.parquet', '.pq'):
+        data = load_parquet(path, column)
+    else:
+        raise ValueError(f"Unknown data file type: {path}")
+    if resolution is not None and resolution != target:
+        data = eo.resample(data, resolution, target, how, start)
+    if steps is not None and len(data) < steps:
+        raise ValueError(f"{path} has {len(data)} time steps, {steps} needed")
+    return data
+
+def load_npy(path):
+    """ Memory maps a .npy file. Data that isn't float64 is converted,
+    which means it is read into memory.
+    """
+    data = np.load(path, mmap_mode='r')
+    if data.dtype != np.float64:
+        data = data.astype(np.float64)
+    return data
+
+def load_csv(path, column=None, delimiter=None):
+    """ Reads one column of a CSV file with a header line. column is a
+    column name or index, and can be left out if the file has a single
+    column. The delimiter is guessed from the header if not given.
+    """
+    with open(path) as f:
+        header = f.readline()
+    if delimiter is None:
+        delimiter = max((',', ';', '\t'), key=header.count)
+    names = [ name.strip().strip('"') for name in header.split(delimiter) ]
+    if column is None:
+        if len(names) > 1:
+            raise ValueError(f"{path} has several columns, pick one of {names}")
+        index = 0
+    elif isinstance(column, int):
+        index = column
+    else:
+        index = names.index(column)
+    return np.loadtxt(path, delimiter=delimiter, skiprows=1, usecols=index, dtype=np.float64, ndmin=1)
+
+def load_parquet(path, column=None):
+    """ Reads one column of a Parquet file. Requires pyarrow.
+    """
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("Reading Parquet files requires pyarrow")
+    table = pq.read_table(path, columns=None if column is None else [column])
+    if column is None:
+        if table.num_columns > 1:
+            raise ValueError(f"{path} has several columns, pick one of {table.column_names}")
+        column = table.column_names[0]
+    return table.column(column).to_numpy().astype(np.float64, copy=False)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+import numpy as np
+from scipy import sparse
+from scipy.optimize import linprog
+
+## LINEAR PROGRAMMING DISPATCH
+#
+# Perfect-foresight dispatch for Simulation.run_optimal(). The whole
+# horizon is one sparse linear program, solved with HiGHS through
+# scipy.optimize.linprog(). Its variables are, for every time step:
+#
+#   - the activity of every stateful entity, between 0 and 1, i.e. the
+#     regulator output of the simulation relaxed to any part of the
+#     rated power, see Simulation.incidence()
+#   - the charge of every storage, between 0 and its capacity
+#   - the overflow and the unmet demand of every grid with storages
+#
+# Every grid with storages must balance every time step: what its
+# storages take in, plus overflow, minus unmet demand, equals what the
+# entities put on the grid. Grids without storages take anything, like
+# fuel grids, and are where costs usually apply.
+
+def dispatch(sim, start, stop, costs=None, unmet=1000, cyclic=False):
+    """ Solves the dispatch of sim from time step start to stop and
+    writes it into its preallocated series, whose grid balances must
+    hold the stateless contributions, see Simulation.run_optimal().
+    Returns the linprog() result. Raises a ValueError if the solver
+    fails.
+    """
+    n = stop - start
+    entities = list(sim.stateful)
+    storages = list(sim.storages.values())
+    stored = [ g for g in sim.grids.values() if any(s.grid is g for s in storages) ]
+    if costs is None:
+        costs = { name: 1 for name, grid in sim.grids.items() if not any(grid is g for g in stored) }
+    factors = [ e.factors() for e in entities ]
+    charges = [ _initial(s, start) for s in storages ]
+
+    # Variable blocks of n time steps each: entity activities, storage
+    # charges, then overflow and unmet demand of every grid with storages
+    activity = lambda k: k*n
+    charge = lambda k: (len(entities) + k)*n
+    overflow = lambda i: (len(entities) + len(storages) + 2*i)*n
+    shortfall = lambda i: (len(entities) + len(storages) + 2*i + 1)*n
+    size = (len(entities) + len(storages) + 2*len(stored))*n
+
+    c = np.zeros(size)
+    bounds = np.zeros((size, 2))
+    for k, entity in enumerate(entities):
+        c[activity(k):activity(k)+n] = sum(costs.get(grid, 0)*abs(f) for grid, f in factors[k].items())
+        bounds[activity(k):activity(k)+n, 1] = 1 if entity.signal else 0
+    for k, storage in enumerate(storages):
+        bounds[charge(k):charge(k)+n, 1] = storage.capacity
+        if cyclic:
+            bounds[charge(k)+n-1, 0] = min(charges[k], storage.capacity)
+    for i in range(len(stored)):
+        bounds[overflow(i):overflow(i)+n, 1] = np.inf
+        bounds[shortfall(i):shortfall(i)+n, 1] = np.inf
+        c[shortfall(i):shortfall(i)+n] = unmet
+
+    steps = np.arange(n)
+    rows, columns, values = [], [], []
+    def add(row, column, value):
+        rows.append(row)
+        columns.append(column)
+        values.append(np.broadcast_to(value, row.shape))
+    b = np.zeros(len(stored)*n)
+    for i, grid in enumerate(stored):
+        row = i*n + steps
+        for k in range(len(entities)):
+            f = factors[k].get(grid.name)
+            if f:
+                add(row, activity(k) + steps, -f)
+        for k, storage in enumerate(storages):
+            if storage.grid is grid:
+                add(row, charge(k) + steps, 1.0)
+                add(row[1:], charge(k) + steps[:-1], -1.0)
+                b[i*n] += charges[k]
+                b[i*n+1:(i+1)*n] -= _selfdischarge(storage)
+        add(row, overflow(i) + steps, 1.0)
+        add(row, shortfall(i) + steps, -1.0)
+        b[i*n:(i+1)*n] += grid.balance[start:stop]
+    if stored:
+        A = sparse.csr_array( (np.concatenate(values), (np.concatenate(rows), np.concatenate(columns)))
+                            , shape=(len(b), size) )
+        result = linprog(c, A_eq=A, b_eq=b, bounds=bounds, method='highs')
+    else:
+        result = linprog(c, bounds=bounds, method='highs')
+    if not result.success:
+        raise ValueError(f"LP dispatch failed: {result.message}")
+    x = result.x
+
+    for k, entity in enumerate(entities):
+        u = np.clip(x[activity(k):activity(k)+n], 0, 1)
+        for grid, f in factors[k].items():
+            entity.powers[grid][start:stop] = f*u
+            if not any(sim.grids[grid] is g for g in stored):
+                sim.grids[grid].balance[start:stop] += f*u
+        running = u > 1e-9
+        entity.regulator.states[start:stop] = ~running if entity.regulator.flip else running
+    for k, storage in enumerate(storages):
+        level = np.clip(x[charge(k):charge(k)+n], 0, storage.capacity)
+        previous = np.concatenate(([charges[k]], level[:-1] - _selfdischarge(storage)))
+        storage.charges[start:stop] = level
+        storage.output[start:stop] = previous - level
+        storage.charge = level[-1] if n else storage.charge
+    for i, grid in enumerate(stored):
+        grid.balance[start:stop] = x[overflow(i):overflow(i)+n] - x[shortfall(i):shortfall(i)+n]
+    return result
+
+def _selfdischarge(storage):
+    return getattr(storage, 'selfDischargeRate', 0)*storage.capacity
+
+def _initial(storage, start):
+    """ Returns the charge of storage going into time step start.
+    """
+    if start == 0:
+        return storage.initialCharge
+    return storage.charges[start-1] - _selfdischarge(storage)
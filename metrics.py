@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import energyoptinator as eo
+
+## KEY PERFORMANCE INDICATORS
+#
+# Vectorized KPIs of a finished simulation: energy totals, unmet demand,
+# regulator starts and running hours, storage state of charge extremes,
+# full-load hours and the BBR primary energy number. track() attaches reducers
+# computing the same KPIs while the simulation runs, see
+# Simulation.add_reducer(), so they need no full histories and work
+# with Simulation.stream().
+#
+# Series hold the energy of every time step, like the 6 minute steps of
+# test.py, so totals are plain sums; hours is the length of a time
+# step in hours.
+#
+# Every KPI also works on a result store opened with
+# store.open_results(), whose regulators are keyed by their entity.
+
+def energy(sim, grid, name=None):
+    """ Returns the total of one series on grid, the grid balance if
+    name is not given.
+    """
+    grid = sim.grids[grid]
+    return np.sum(grid.powers[name or grid.name], axis=0)*grid.rate
+
+def energies(sim):
+    """ Returns a dictionary of grid names and dictionaries of the
+    total of every series on the grid.
+    """
+    return { gridname: { name: energy(sim, gridname, name) for name in grid.powers }
+             for gridname, grid in sim.grids.items() }
+
+def unmet(sim, grid):
+    """ Returns the demand left unmet on grid, the total of its negative
+    balance after its storages, as a positive number.
+    """
+    grid = sim.grids[grid]
+    return np.sum(np.maximum(-np.asarray(grid.powers[grid.name]), 0), axis=0)*grid.rate
+
+def starts(sim, entity):
+    """ Returns the number of times the regulator of entity turned on.
+    """
+    states = np.asarray(_states(sim, entity)[0])
+    return np.sum((states[:-1] == 0) & (states[1:] == 1), axis=0)
+
+def run_hours(sim, entity, hours=0.1):
+    """ Returns the hours the regulator of entity was on.
+    """
+    states, rate = _states(sim, entity)
+    return np.count_nonzero(states, axis=0)*hours*rate
+
+def _states(sim, entity):
+    """ Returns the states of the regulator of entity and the time
+    steps per state, from a Simulation or a result store.
+    """
+    if isinstance(sim, eo.Simulation):
+        entity = sim.entities[entity]
+        return entity.regulator.states, entity.rate
+    regulator = sim.regulators[entity]
+    return regulator.states, regulator.rate
+
+def soc_range(sim, storage):
+    """ Returns the lowest and highest state of charge of storage.
+    """
+    storage = sim.storages[storage]
+    charges = np.asarray(storage.charges)
+    return np.min(charges, axis=0)/storage.capacity, np.max(charges, axis=0)/storage.capacity
+
+def full_load_hours(sim, entity, grid, ratedPower, hours=0.1):
+    """ Returns the hours entity would have needed at ratedPower, the
+    energy of a time step at full load, to deliver what it did to grid.
+    """
+    return abs(energy(sim, grid, entity))/ratedPower*hours
+
+def primary_energy_number(sim, fuels, area, weight=0.6):
+    """ Returns the primary energy number according to BBR 29, in
+    energy per m² and year: the total drawn from the fuel grids fuels,
+    weighted with weight, per area m² of heated floor area.
+    """
+    return sum(abs(energy(sim, fuel)) for fuel in fuels)*weight/area
+
+def _stored(sim):
+    """ Returns the names of the grids with storages, the only ones
+    where a negative balance is unmet demand rather than a fuel draw.
+    """
+    return [ name for name, grid in sim.grids.items() if any(s.grid is grid for s in sim.storages.values()) ]
+
+def _regulated(sim):
+    if not isinstance(sim, eo.Simulation):
+        return list(sim.regulators)
+    return [ name for name, entity in sim.entities.items() if getattr(entity, 'regulator', None) is not None ]
+
+def track(sim, hours=0.1):
+    """ Adds reducers to sim for the total of every series, the unmet
+    demand of every grid with storages, the starts and running hours of
+    every regulator and the state of charge
+    extremes of every storage, so kpis() gets them without scanning
+    full histories. Only steps simulated after track() are counted.
+    Returns sim.
+    """
+    for gridname, grid in sim.grids.items():
+        for name in grid.powers:
+            sim.add_reducer( f"energy/{gridname}/{name}"
+                           , eo.Sum(grid.rate)
+                           , lambda s, gridname=gridname, name=name: s.grids[gridname].powers[name] )
+    for name in _stored(sim):
+        sim.add_reducer( f"unmet/{name}"
+                       , eo.Shortfall(sim.grids[name].rate)
+                       , lambda s, name=name: s.grids[name].powers[name] )
+    for name in _regulated(sim):
+        entity = sim.entities[name]
+        sim.add_reducer(f"starts/{name}", eo.Starts(), lambda s, name=name: s.entities[name].regulator.states)
+        sim.add_reducer( f"run_hours/{name}"
+                       , eo.RunTime(hours*entity.rate)
+                       , lambda s, name=name: s.entities[name].regulator.states )
+    for name, storage in sim.storages.items():
+        sim.add_reducer(f"charge_min/{name}", eo.Minimum(), lambda s, name=name: s.storages[name].charges)
+        sim.add_reducer(f"charge_max/{name}", eo.Maximum(), lambda s, name=name: s.storages[name].charges)
+    return sim
+
+def kpis(sim, hours=0.1):
+    """ Returns a dictionary of KPIs keyed like track() names them,
+    with charge extremes turned into soc_min and soc_max. If sim is
+    tracked the reducers are used, otherwise the KPIs are computed from
+    the histories in memory or, for a result store opened with
+    store.open_results(), on disk.
+    """
+    results = sim.results() if isinstance(sim, eo.Simulation) else {}
+    if not any(key.startswith('energy/') for key in results):
+        results = {}
+        for gridname, totals in energies(sim).items():
+            for name, total in totals.items():
+                results[f"energy/{gridname}/{name}"] = total
+        for name in _stored(sim):
+            results[f"unmet/{name}"] = unmet(sim, name)
+        for name in _regulated(sim):
+            results[f"starts/{name}"] = starts(sim, name)
+            results[f"run_hours/{name}"] = run_hours(sim, name, hours)
+        for name in sim.storages:
+            low, high = soc_range(sim, name)
+            results[f"soc_min/{name}"] = low
+            results[f"soc_max/{name}"] = high
+        return results
+    output = {}
+    for key, value in results.items():
+        kind, _, name = key.partition('/')
+        if kind in ('charge_min', 'charge_max'):
+            output[f"soc_{kind[7:]}/{name}"] = value/sim.storages[name].capacity
+        else:
+            output[key] = value
+    return output
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+import math
+import numpy as np
+import metrics
+
+## MONTE CARLO
+#
+# The profiles of svenska_schabloner and the monthly irradiance of
+# test.py are averages, which hide the tail risk of e.g. a dark, cold
+# January draining the battery. A MonteCarlo runs a simulation over
+# many randomized load and irradiance traces and reports percentiles of
+# its KPIs, like fuel use, generator starts and unmet demand.
+#
+# Traces are generated a batch at a time as (steps, scenarios) arrays
+# and simulated as batched scenarios, see Simulation.scenarios(), with
+# Simulation.stream() and the reducers of metrics.track(), so only the
+# KPIs of every scenario are kept, not its traces or series. Every batch
+# draws from its own seeded generator, so a run is reproducible for the
+# same seed and batch size.
+#
+# daily_factors(), perturb() and resample_days() are vectorized building
+# blocks for the trace functions.
+
+class MonteCarlo:
+    def __init__( self
+                , build
+                , traces
+                , kpis
+                , steps
+                , scenarios = 1000
+                , batch = 100
+                , seed = 0
+                , percentiles = (5, 50, 95)
+                , chunk = 8760 ):
+        """ Creates a Monte Carlo study.
+
+        traces is a function taking a numpy random Generator and a
+        number of scenarios n, and returning a dictionary of profile
+        names and (steps, n) arrays. build is a function taking one
+        keyword argument per profile and returning a Simulation, which
+        is streamed steps time steps, chunk at a time.
+
+        kpis is a dictionary of names and KPIs: keys of metrics.kpis(),
+        like 'unmet/Electricity' or 'starts/Generator', or functions
+        taking the metrics.kpis() dictionary and returning a value per
+        scenario.
+
+        scenarios are simulated batch at a time; memory use grows with
+        batch, the time per scenario shrinks with it.
+        """
+        self.build = build
+        self.traces = traces
+        self.kpis = kpis
+        self.steps = steps
+        self.scenarios = scenarios
+        self.batch = batch
+        self.seed = seed
+        self.percentiles = percentiles
+        self.chunk = chunk
+        self.values = { name: [] for name in kpis }
+
+    def batches(self):
+        """ Simulates all scenarios and yields the summary() after every
+        batch, so percentiles can be watched as they converge.
+        """
+        self.values = { name: [] for name in self.kpis }
+        count = math.ceil(self.scenarios/self.batch)
+        for index, seed in enumerate(np.random.SeedSequence(self.seed).spawn(count)):
+            n = min(self.batch, self.scenarios - index*self.batch)
+            s = metrics.track(self.build(**self.traces(np.random.default_rng(seed), n)))
+            s.stream(self.steps, chunk=self.chunk)
+            results = metrics.kpis(s)
+            for name, kpi in self.kpis.items():
+                value = results[kpi] if isinstance(kpi, str) else kpi(results)
+                self.values[name].append(np.broadcast_to(np.asarray(value, dtype=np.float64), (n,)))
+            yield self.summary()
+
+    def run(self):
+        """ Simulates all scenarios and returns the summary().
+        """
+        for _ in self.batches():
+            pass
+        return self.summary()
+
+    def column(self, name):
+        """ Returns the values of one KPI for every scenario simulated so
+        far, as a numpy array.
+        """
+        return np.concatenate(self.values[name]) if self.values[name] else np.empty(0)
+
+    def summary(self):
+        """ Returns a dictionary of KPI names and dictionaries of the
+        mean and the percentiles of the KPI over the scenarios simulated
+        so far, and the number of them under 'scenarios'.
+        """
+        summary = { 'scenarios': sum(len(v) for v in next(iter(self.values.values()), [])) }
+        for name in self.kpis:
+            column = self.column(name)
+            if len(column):
+                summary[name] = { 'mean': float(np.mean(column))
+                                , **{ p: float(p_value) for p, p_value in zip(self.percentiles, np.percentile(column, self.percentiles)) } }
+        return summary
+
+
+def montecarlo(build, traces, kpis, steps, scenarios=1000, batch=100, seed=0, percentiles=(5, 50, 95)):
+    """ Runs a Monte Carlo study, see MonteCarlo, and returns its
+    summary().
+    """
+    return MonteCarlo(build, traces, kpis, steps, scenarios, batch, seed, percentiles).run()
+
+def daily_factors(rng, days, scenarios, sigma=0.3, correlation=0.7):
+    """ Returns a (days, scenarios) array of random day-to-day factors
+    with mean 1: lognormal, with sigma the standard deviation of their
+    logarithm, and correlated from one day to the next like weather,
+    so dark or cold spells last a few days. Multiply a profile by the
+    factors with perturb(); using the same factors, or their powers,
+    for several profiles correlates them, e.g. factors**-0.5 for space
+    heating makes dark days cold.
+    """
+    noise = rng.standard_normal((days, scenarios))
+    # AR(1) process with unit variance, stepped a day at a time over all
+    # scenarios
+    scale = math.sqrt(1 - correlation**2)
+    for day in range(1, days):
+        noise[day] = correlation*noise[day-1] + scale*noise[day]
+    return np.exp(sigma*noise - sigma**2/2)
+
+def perturb(profile, factors, steps_per_day=240):
+    """ Returns profile, one value per time step or (steps, scenarios),
+    multiplied by daily factors, see daily_factors(), as a (steps,
+    scenarios) array. steps_per_day is 240 for 6 minute time steps.
+    """
+    profile = np.asarray(profile, dtype=np.float64)
+    scaled = np.repeat(factors, steps_per_day, axis=0)[:len(profile)]
+    if len(scaled) < len(profile):
+        raise ValueError(f"{len(factors)} days of factors don't cover {len(profile)} time steps")
+    return (profile if profile.ndim > 1 else profile[:, np.newaxis])*scaled
+
+def resample_days(years, rng, scenarios, steps_per_day=240, block=7, spread=15):
+    """ Builds weather years by resampling whole days of measured or
+    modelled years. years is one series, or a (steps, years) array of
+    several, covering whole days. Every block of days of every scenario
+    is copied from a random year, shifted by a random number of days of
+    at most spread, so the season is kept while the weather varies.
+    Returns a (steps, scenarios) array.
+    """
+    years = np.asarray(years, dtype=np.float64)
+    if years.ndim == 1:
+        years = years[:, np.newaxis]
+    steps, count = years.shape
+    if steps % steps_per_day:
+        raise ValueError(f"{steps} time steps are not whole days of {steps_per_day} steps")
+    days = steps//steps_per_day
+    blocks = -(-days // block)
+    year = np.repeat(rng.integers(0, count, (blocks, scenarios)), block, axis=0)[:days]
+    shift = np.repeat(rng.integers(-spread, spread + 1, (blocks, scenarios)), block, axis=0)[:days]
+    day = np.clip(np.arange(days)[:, np.newaxis] + shift, 0, days - 1)
+    # (days, steps per day, years) -> (days, scenarios, steps per day)
+    daily = years.reshape(days, steps_per_day, count)[day, :, year]
+    return daily.transpose(0, 2, 1).reshape(steps, scenarios)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+import math
+
+## SIZING OPTIMIZER
+#
+# An Optimizer finds the smallest component sizes, like solar area,
+# battery capacity or boiler rated power, for which a simulation meets
+# a set of KPI constraints, like a maximum fuel use or a maximum number
+# of generator starts. Instead of scanning every size like a Sweep, it
+# bisects one size at a time, relying on bigger components never making
+# a constraint harder to meet, so every answer takes a handful of runs.
+#
+# Sizes usually trade off against each other, e.g. more solar area for
+# a smaller battery, so there is no single smallest set of sizes. The
+# answer is the lexicographic minimum in the order the sizes are given:
+# the first size as small as it can be, then the second as small as it
+# can be with the first held, and so on. Order the sizes by which is
+# most important to keep small.
+
+class Optimizer:
+    def __init__( self
+                , build
+                , sizes
+                , constraints
+                , profiles = None
+                , steps = None ):
+        """ Creates a sizing optimizer.
+
+        build is a function taking one keyword argument per size in
+        sizes and per profile in profiles, and returning a Simulation.
+        If steps is given, the simulation is run that many steps after
+        building, otherwise build is expected to run it.
+
+        sizes is a dictionary of size names and (low, high) or (low,
+        high, resolution) ranges; sizes are searched in steps of
+        resolution, 1 by default. constraints is a dictionary of names
+        and (kpi, maximum) pairs, where kpi is a function taking a
+        finished Simulation and returning a number that must not exceed
+        maximum. For a minimum, negate the KPI and the limit.
+
+        Every constraint must be monotone in every size: if a size
+        meets the constraints, so does every bigger size. The order of
+        sizes decides the answer, see run().
+        """
+        self.build = build
+        self.sizes = sizes
+        self.constraints = constraints
+        self.profiles = profiles or {}
+        self.steps = steps
+        self.evaluations = {}
+        self.result = None
+
+    def value(self, name, index):
+        """ Returns the index:th value of a size, counting in steps of
+        its resolution from low and ending at high.
+        """
+        low, high, resolution = (*self.sizes[name], 1)[:3]
+        if index >= math.ceil((high - low)/resolution):
+            return high
+        return low + index*resolution
+
+    def evaluate(self, point):
+        """ Builds and runs the simulation for point, a dictionary of
+        size names and values, and returns a dictionary of its KPIs.
+        Results are cached, so every point is only simulated once.
+        """
+        key = tuple(point[name] for name in self.sizes)
+        if key not in self.evaluations:
+            s = self.build(**point, **self.profiles)
+            if self.steps is not None:
+                s.run(self.steps)
+            self.evaluations[key] = { name: kpi(s) for name, (kpi, _) in self.constraints.items() }
+        return self.evaluations[key]
+
+    def feasible(self, point):
+        """ Returns True if point meets every constraint.
+        """
+        kpis = self.evaluate(point)
+        return all(kpis[name] <= maximum for name, (_, maximum) in self.constraints.items())
+
+    def run(self):
+        """ Searches for the lexicographically smallest sizes meeting
+        the constraints, in the order of self.sizes. Starting from the
+        biggest sizes, every size in turn is bisected down to the
+        smallest feasible value, with the sizes before it held at theirs
+        and the sizes after it at their biggest. Shrinking a size only
+        makes the others harder to shrink, so one pass is final.
+
+        Returns a dictionary of the sizes found followed by their KPIs,
+        also kept in self.result. Raises a ValueError if even the
+        biggest sizes break a constraint.
+        """
+        indices = { name: math.ceil((size[1] - size[0])/(*size, 1)[2]) for name, size in self.sizes.items() }
+        if not self.feasible(self._point(indices)):
+            raise ValueError(f"no sizes meet the constraints, the biggest sizes give {self.evaluate(self._point(indices))}")
+        for name in self.sizes:
+            indices[name] = self._bisect(indices, name)
+        point = self._point(indices)
+        self.result = { **point, **self.evaluate(point) }
+        return self.result
+
+    def _point(self, indices):
+        return { name: self.value(name, index) for name, index in indices.items() }
+
+    def _bisect(self, indices, name):
+        """ Returns the index of the smallest feasible value of one
+        size, with the other sizes held at indices. The current index
+        is known to be feasible.
+        """
+        low, high = -1, indices[name]
+        while high - low > 1:
+            middle = (low + high)//2
+            if self.feasible(self._point({ **indices, name: middle })):
+                high = middle
+            else:
+                low = middle
+        return high
+
+
+def optimize(build, sizes, constraints, profiles=None, steps=None):
+    """ Finds the lexicographically smallest sizes meeting the
+    constraints, in the order of sizes, see Optimizer. Returns a
+    dictionary of the sizes followed by their KPIs.
+    """
+    return Optimizer(build, sizes, constraints, profiles, steps).run()
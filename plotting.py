@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import energyoptinator as eo
+
+## HEADLESS PLOTTING
+#
+# Figures of simulations built as explicit Figure objects on the Agg
+# canvas, without pyplot's global state, so they can be rendered in
+# scripts, on servers and in many worker processes at once. Series are
+# decimated to the horizontal pixels of their axes before plotting, so
+# drawing costs the same for a week as for ten years of data.
+
+def decimate(data, pixels=2000):
+    """ Reduces a series to at most two points per pixel, the lowest and
+    highest value of every bucket of time steps, in time order, so
+    peaks survive. Returns the time step indices and values of the
+    points kept. Series of batched scenarios, (steps, scenarios)
+    arrays, are bucketed by their mean over the scenarios.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    n = len(data)
+    if n <= 2*pixels:
+        return np.arange(n), data
+    size = -(-n // pixels)
+    level = data.mean(axis=1) if data.ndim > 1 else data
+    buckets = -(-n // size)
+    padded = np.full(buckets*size, np.nan)
+    padded[:n] = level
+    padded = padded.reshape(buckets, size)
+    low = np.nanargmin(padded, axis=1)
+    high = np.nanargmax(padded, axis=1)
+    start = np.arange(buckets)*size
+    x = np.stack((start + np.minimum(low, high), start + np.maximum(low, high)), axis=1).ravel()
+    return x, data[x]
+
+def _pixels(fig, columns=1):
+    return int(fig.get_figwidth()*fig.dpi/columns)
+
+def grids_figure(sim, dpi=96):
+    """ Returns a figure of the balance of every grid over time.
+    """
+    fig = Figure(dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    for name, grid in sim.grids.items():
+        x, y = decimate(grid.powers[name], _pixels(fig))
+        ax.plot(x*grid.rate, y, label=name)
+    fig.legend()
+    ax.set_title(sim.name)
+    return fig
+
+def storages_figure(sim, dpi=96):
+    """ Returns a figure of the charge of every storage over time.
+    """
+    fig = Figure(dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    for name, storage in sim.storages.items():
+        x, y = decimate(storage.charges, _pixels(fig))
+        ax.plot(x*storage.grid.rate, y, label=name)
+    fig.legend()
+    ax.set_title(sim.name)
+    return fig
+
+def all_figure(sim, dpi=120):
+    """ Returns an overview figure with the weekly totals of every
+    series of every grid, and the hourly state of charge of every
+    storage, for 6 minute time steps.
+    """
+    n = len(sim.grids)
+    m = len(sim.storages)
+    fig = Figure(figsize=(16, 4.5*n/2), dpi=dpi)
+    FigureCanvasAgg(fig)
+    axlist = np.atleast_1d(fig.subplots(math.ceil((n+m)/2), 2))
+    pixels = _pixels(fig, 2)
+    for ax, (gridname, grid) in zip(axlist.flatten()[:n], sim.grids.items()):
+        for name, data in grid.powers.items():
+            ax.plot(eo.hourly_to_weekly(eo._6min_to_hourly(np.repeat(data, grid.rate, axis=0))), label=name)
+        ax.set_title(gridname)
+        ax.set_xlabel(grid.timesteplabel)
+        ax.set_ylabel(grid.unit)
+        ax.legend( bbox_to_anchor=(1.05, 1) )
+    for ax, (storagename, storage) in zip(axlist.flatten()[n:], sim.storages.items()):
+        charges = np.repeat(storage.charges, storage.grid.rate, axis=0)
+        soc = eo._6min_to_hourly(charges[1:]/10)/storage.capacity
+        ax.plot(*decimate(soc, pixels), label=storagename)
+        ax.set_title(f"{storagename}, {storage.capacity} kWh")
+        ax.set_ylabel('SoC')
+        ax.set_xlabel('Hour')
+        ax.legend( bbox_to_anchor=(1.05, 1) )
+    fig.suptitle(sim.name)
+    fig.tight_layout()
+    return fig
+
+FIGURES = { 'grids': grids_figure
+          , 'storages': storages_figure
+          , 'all': all_figure
+          }
+
+def render(sim, path, kind='all', dpi=96):
+    """ Renders a figure of sim, 'grids', 'storages' or 'all', to the
+    image file path. sim may also be the directory of a result store,
+    see store.open_results().
+    """
+    if isinstance(sim, (str, os.PathLike)):
+        from store import open_results
+        sim = open_results(sim)
+    fig = FIGURES[kind](sim)
+    fig.savefig(path, dpi=dpi)
+    return path
+
+def _render(job):
+    return render(*job)
+
+def _plotted(sim):
+    """ Returns what the figures read of sim, its name and the series
+    of its grids and storages, as plain namespaces, for sending to
+    worker processes. Simulations themselves may not pickle, e.g. with
+    the lambdas of metrics.track(). Result stores are sent as their
+    directory.
+    """
+    if isinstance(sim, (str, os.PathLike)):
+        return sim
+    if hasattr(sim, 'path'):
+        return sim.path
+    grids = { name: SimpleNamespace( unit=grid.unit
+                                   , timesteplabel=grid.timesteplabel
+                                   , rate=grid.rate
+                                   , powers={ key: np.asarray(series) for key, series in grid.powers.items() } )
+              for name, grid in sim.grids.items() }
+    storages = { name: SimpleNamespace( capacity=storage.capacity
+                                      , charges=np.asarray(storage.charges)
+                                      , grid=grids[storage.grid.name] )
+                 for name, storage in sim.storages.items() }
+    return SimpleNamespace(name=sim.name, grids=grids, storages=storages)
+
+def render_many(jobs, processes=None):
+    """ Renders many figures in parallel worker processes. jobs is a
+    list of (sim, path) or (sim, path, kind) tuples, see render();
+    passing result store directories instead of simulations saves
+    pickling every series to the workers. Only the series are sent, see
+    _plotted(). With processes=1 the figures are rendered in this
+    process. Returns the paths written.
+    """
+    jobs = [ tuple(job) for job in jobs ]
+    processes = processes or os.cpu_count()
+    if processes == 1 or len(jobs) < 2:
+        return [ _render(job) for job in jobs ]
+    jobs = [ (_plotted(job[0]), *job[1:]) for job in jobs ]
+    with ProcessPoolExecutor(min(processes, len(jobs))) as pool:
+        return list(pool.map(_render, jobs))
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import json
+import time
+import tracemalloc
+
+## PROFILER
+#
+# Per-entity profiling for Simulation(profile=True). Simulation.compile()
+# instruments the step, fill and dispatch methods of every grid, entity
+# and storage, and wraps every regulator signal, in timers that count
+# calls and time spent. The results are available as a summary table
+# and as a Chrome trace-event file, which speedscope.app also opens.
+
+class Profiler:
+    def __init__(self, memory=False, max_events=1000000):
+        """ Creates a profiler. With memory=True, the memory allocated
+        in every call is recorded as well, through tracemalloc, which
+        slows the simulation down considerably. At most max_events
+        calls are kept for the trace, every call is counted in the
+        summary.
+        """
+        self.stats = {}
+        self.events = []
+        self.memory = memory
+        self.max_events = max_events
+        self.origin = time.perf_counter_ns()
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def wrap(self, method, label):
+        """ Returns method wrapped in a timer recording under label.
+        Wrapping a timer again returns it unchanged.
+        """
+        if isinstance(method, _Timed):
+            return method
+        if self.memory:
+            return _TimedMemory(self, method, label)
+        return _Timed(self, method, label)
+
+    def instrument(self, obj, methods, label):
+        """ Times the methods of obj named in methods, those it has, under
+        label.method. Since the entity classes have __slots__, obj is
+        moved to a subclass of its class with timed methods rather than
+        given timed instance attributes. Instrumenting an object again
+        does nothing.
+        """
+        cls = type(obj)
+        if getattr(cls, '_profiler', None) is self:
+            return
+        timed = { name: self._method(getattr(cls, name), f"{label}.{name}")
+                  for name in methods if hasattr(cls, name) }
+        obj.__class__ = type(cls.__name__, (cls,), { '__slots__': (), '_profiler': self, **timed })
+
+    def _method(self, function, label):
+        timer = self.wrap(function, label)
+        def method(obj, *args):
+            return timer(obj, *args)
+        return method
+
+    def table(self):
+        """ Returns a list with one dictionary per label, holding its
+        number of calls, total time in seconds, mean time per call and
+        allocated bytes, sorted by total time. Times include the time
+        of nested calls, like the signal() an entity's step reads.
+        """
+        rows = [ { 'label': label
+                 , 'calls': calls
+                 , 'time': elapsed/1e9
+                 , 'per_call': elapsed/1e9/calls if calls else 0
+                 , 'allocated': allocated if self.memory else None }
+                 for label, (calls, elapsed, allocated) in self.stats.items() ]
+        return sorted(rows, key=lambda row: -row['time'])
+
+    def summary(self, limit=None):
+        """ Returns the table() as text, the limit most expensive labels
+        only if limit is given.
+        """
+        rows = self.table()[:limit]
+        width = max([ len(row['label']) for row in rows ] + [5])
+        lines = [ f"{'label':<{width}} {'calls':>9} {'total ms':>10} {'µs/call':>8}"
+                  + (f" {'alloc KiB':>10}" if self.memory else "") ]
+        for row in rows:
+            lines.append( f"{row['label']:<{width}} {row['calls']:>9} {row['time']*1e3:>10.1f} {row['per_call']*1e6:>8.2f}"
+                        + (f" {row['allocated']/1024:>10.1f}" if self.memory else "") )
+        return "\n".join(lines)
+
+    def export_trace(self, path):
+        """ Writes the recorded calls to path as a Chrome trace-event
+        JSON file, for chrome://tracing, ui.perfetto.dev or
+        speedscope.app.
+        """
+        events = [ { 'name': label
+                   , 'ph': 'X'
+                   , 'ts': (start - self.origin)/1000
+                   , 'dur': duration/1000
+                   , 'pid': 1
+                   , 'tid': 1 }
+                   for label, start, duration in self.events ]
+        with open(path, 'w') as f:
+            json.dump({ 'traceEvents': events, 'displayTimeUnit': 'ms' }, f)
+
+    def clear(self):
+        self.stats.clear()
+        self.events.clear()
+        self.origin = time.perf_counter_ns()
+
+
+class _Timed:
+    """ Callable timing every call of method. Bound methods keep their
+    __self__, since the simulation inspects whose soc() a signal is.
+    """
+    def __init__(self, profiler, method, label):
+        self.profiler = profiler
+        self.method = method
+        self.label = label
+        self.__self__ = getattr(method, '__self__', None)
+        self.stats = profiler.stats.setdefault(label, [0, 0, 0])
+
+    def __call__(self, *args):
+        start = time.perf_counter_ns()
+        result = self.method(*args)
+        duration = time.perf_counter_ns() - start
+        stats = self.stats
+        stats[0] += 1
+        stats[1] += duration
+        events = self.profiler.events
+        if len(events) < self.profiler.max_events:
+            events.append((self.label, start, duration))
+        return result
+
+
+class _TimedMemory(_Timed):
+    """ _Timed also recording the memory allocated by every call.
+    """
+    def __call__(self, *args):
+        before = tracemalloc.get_traced_memory()[0]
+        result = super().__call__(*args)
+        self.stats[2] += max(0, tracemalloc.get_traced_memory()[0] - before)
+        return result
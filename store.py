@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+import json
+import os
+from collections.abc import Mapping
+import numpy as np
+import energyoptinator as eo
+
+## RESULT STORE
+#
+# A result store is a directory holding one .npy file per series of a
+# simulation, written through numpy.memmap, and a meta.json describing
+# them. Stores are written chunk by chunk while a simulation streams,
+# see Simulation.stream(), and reopened lazily with open_results(), so
+# runs that don't fit in memory can still be plotted and analysed.
+
+class ResultStore:
+    def __init__(self, path, sim, n_steps, start=None):
+        """ Creates a result store in the directory path, with room for
+        n_steps time steps of every series in sim, beginning at time
+        step start (by default the simulation's current step).
+        """
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.sim = sim
+        self.start = sim.steps() if start is None else start
+        scenarios = sim.scenarios()
+        shape = () if scenarios is None else (scenarios,)
+        meta = { 'name': sim.name
+               , 'start': self.start
+               , 'steps': n_steps
+               , 'scenarios': scenarios
+               , 'grids': { name: { 'unit': grid.unit, 'timesteplabel': grid.timesteplabel, 'rate': grid.rate }
+                            for name, grid in sim.grids.items() }
+               , 'storages': { name: { 'capacity': np.asarray(storage.capacity).tolist(), 'grid': storage.grid.name }
+                               for name, storage in sim.storages.items() }
+               , 'series': []
+               }
+        self.columns = []
+        for i, (key, series, dtype, rate) in enumerate(_columns(sim)):
+            filename = f"series_{i:04d}.npy"
+            column = np.lib.format.open_memmap( os.path.join(path, filename)
+                                              , mode='w+'
+                                              , dtype=dtype
+                                              , shape=(n_steps//rate,) + shape )
+            self.columns.append((series, column, rate))
+            meta['series'].append({ 'key': key, 'file': filename, 'rate': rate })
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=1)
+
+    def write(self, start, stop):
+        """ Writes time steps start to stop of every series to the
+        store. The steps must still be in the simulation's memory.
+        """
+        offset = self.sim.offset
+        for series, column, rate in self.columns:
+            column[(start-self.start)//rate:(stop-self.start)//rate] = series()[(start-offset)//rate:(stop-offset)//rate]
+
+    def flush(self):
+        for _, column, _ in self.columns:
+            column.flush()
+
+
+def _columns(sim):
+    """ Returns a list of (key, series, dtype, rate) for every series in
+    sim, where series is a function returning the current series and
+    rate the number of time steps per value. Regulators are keyed by the
+    first entity using them.
+    """
+    columns = []
+    for gridname, grid in sim.grids.items():
+        for name in grid.powers:
+            columns.append(( ['grids', gridname, name]
+                           , lambda grid=grid, name=name: grid.powers[name]
+                           , np.float64
+                           , grid.rate ))
+    for name, storage in sim.storages.items():
+        columns.append(( ['storages', name, 'charges']
+                       , lambda storage=storage: storage.charges
+                       , np.float64
+                       , storage.grid.rate ))
+    for regulator in sim.regulators():
+        owner = next(name for name, e in sim.entities.items() if getattr(e, 'regulator', None) is regulator)
+        columns.append(( ['regulators', owner, 'states']
+                       , lambda regulator=regulator: regulator.states
+                       , np.int8
+                       , sim.entities[owner].rate ))
+    return columns
+
+
+class _LazyColumns(Mapping):
+    """ Read-only dictionary of series names and .npy files, memory
+    mapping each file on first access.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        self.loaded = {}
+
+    def __getitem__(self, name):
+        if name not in self.loaded:
+            self.loaded[name] = np.load(os.path.join(self.path, self.files[name]), mmap_mode='r')
+        return self.loaded[name]
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def __len__(self):
+        return len(self.files)
+
+
+class StoredGrid:
+    def __init__(self, name, path, unit, timesteplabel, rate=1):
+        self.name = name
+        self.unit = unit
+        self.timesteplabel = timesteplabel
+        self.rate = rate
+        self.powers = _LazyColumns(path)
+
+
+class StoredStorage:
+    def __init__(self, name, path, capacity, grid):
+        self.name = name
+        self.grid = grid
+        self.capacity = capacity if np.ndim(capacity) == 0 else np.asarray(capacity)
+        self.columns = _LazyColumns(path)
+
+    @property
+    def charges(self):
+        return self.columns['charges']
+
+
+class StoredRegulator:
+    def __init__(self, name, path, rate=1):
+        self.name = name
+        self.rate = rate
+        self.columns = _LazyColumns(path)
+
+    @property
+    def states(self):
+        return self.columns['states']
+
+
+class StoredSimulation:
+    def __init__(self, path):
+        """ Reopens a result store. Grids, storages and regulators
+        are reachable like in a Simulation, through grids[...].powers,
+        storages[...].charges and regulators[entity name].states, but
+        every series is memory mapped from disk on first access.
+        """
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.path = path
+        self.name = meta['name']
+        self.start = meta['start']
+        self.steps = meta['steps']
+        self.scenarios = meta['scenarios']
+        self.grids = { name: StoredGrid(name, path, info['unit'], info['timesteplabel'], info.get('rate', 1))
+                       for name, info in meta['grids'].items() }
+        self.storages = { name: StoredStorage(name, path, info['capacity'], self.grids.get(info.get('grid')))
+                          for name, info in meta['storages'].items() }
+        self.regulators = {}
+        for series in meta['series']:
+            kind, owner, name = series['key']
+            if kind == 'grids':
+                self.grids[owner].powers.files[name] = series['file']
+            elif kind == 'storages':
+                self.storages[owner].columns.files[name] = series['file']
+            else:
+                if owner not in self.regulators:
+                    self.regulators[owner] = StoredRegulator(owner, path, series.get('rate', 1))
+                self.regulators[owner].columns.files[name] = series['file']
+
+    plot_grids = eo.Simulation.plot_grids
+    plot_storages = eo.Simulation.plot_storages
+    plot_all = eo.Simulation.plot_all
+
+
+def open_results(path):
+    """ Lazily opens the result store in the directory path, see
+    StoredSimulation.
+    """
+    return StoredSimulation(path)
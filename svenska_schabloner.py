@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
-from scipy.signal import savgol_filter
 from energyoptinator import *
+from cache import profile_cache
 
 ## Hemsol functions
 #
@@ -23,11 +23,12 @@ def hemsol_tvv(yearly):
     modifiers = [1.1, 1.1, 1, 1, 1, 0.95, 0.8, 0.95, 1, 1, 1, 1.1]
     return _hemsol(yearly, modifiers)
 
-def hemsol_tvv_smoothed(yearly):
+@profile_cache
+def hemsol_tvv_smoothed(yearly, window=201, order=3):
     """ Hemsol hot water splitter. Takes a yearly hot water usage,
     splits it into daily usage and smooths it.
     """
-    return savgol_filter(monthly_to_daily(hemsol_tvv(yearly)), 201, 3)
+    return savgol_filter(monthly_to_daily(hemsol_tvv(yearly)), window, order)
 
 def hemsol_varme(yearly):
     """ Hemsol comfort heat splitter. Takes a yearly comfort heat usage
@@ -36,13 +37,30 @@ def hemsol_varme(yearly):
     modifiers = [2, 1.7, 1.7, 1.3, 0.6, 0.2, 0, 0, 0.4, 0.9, 1.4, 1.8]
     return _hemsol(yearly, modifiers)
 
-def hemsol_varme_smoothed(yearly):
+@profile_cache
+def hemsol_varme_smoothed(yearly, window=201, order=4):
     """ Hemsol comfort heat splitter. Takes a yearly hot water usage,
     splits it into daily usage and smooths it.
     """
-    return savgol_filter(monthly_to_daily(hemsol_varme(yearly)), 201, 4)
+    return savgol_filter(monthly_to_daily(hemsol_varme(yearly)), window, order)
 
-def demo1():
+@profile_cache
+def hemsol_profile(kind, yearly, resolution=SIX_MINUTES, smoothed=False):
+    """ Hemsol profile builder. Takes a yearly hot water ('tvv') or
+    comfort heat ('varme') usage and returns a year of usage per time
+    step at the given resolution, optionally smoothed. Profiles are
+    cached, so building the same profile again is free.
+    """
+    if smoothed:
+        daily = { 'tvv': hemsol_tvv_smoothed, 'varme': hemsol_varme_smoothed }[kind](yearly)
+        return resample(daily, DAY, resolution)
+    monthly = { 'tvv': hemsol_tvv, 'varme': hemsol_varme }[kind](yearly)
+    return resample(monthly, 'month', resolution)
+
+def demo1_sim():
+    """ Builds and steps the simulation of demo1(). Also used by
+    benchmark.py.
+    """
     timesteps = 8760
     hushel = 6700/timesteps
     tvv = daily_to_hourly(hemsol_tvv_smoothed(3000))
@@ -56,6 +74,10 @@ def demo1():
     TimevariantSink('Komfortvärme', s, 'Värme', varme)
     for _ in range(timesteps):
         s.step()
+    return s
+
+def demo1():
+    s = demo1_sim()
     for _, grid in s.grids.items():
         grid.plot()
 
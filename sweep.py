@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+
+## PARAMETER SWEEPS
+#
+# A Sweep runs a scenario-building function over every combination of
+# a parameter grid, spread over a pool of worker processes. Input
+# profiles that are the same for every point are put in shared memory
+# once, instead of being rebuilt or pickled for every point.
+
+class Sweep:
+    def __init__( self
+                , build
+                , grid
+                , kpis
+                , profiles = None
+                , steps = None
+                , processes = None ):
+        """ Creates a parameter sweep.
+
+        build is a function taking one keyword argument per parameter
+        in grid and per profile in profiles, and returning a
+        Simulation. If steps is given, the simulation is run that many
+        steps after building, otherwise build is expected to run it.
+
+        grid is a dictionary of parameter names and the values to try;
+        every combination is a sweep point. kpis is a dictionary of
+        names and functions taking a finished Simulation and returning
+        a number. profiles is a dictionary of names and arrays shared
+        by all points.
+
+        With processes=None the pool gets one worker per CPU, with
+        processes=1 the sweep runs in this process. build and the KPI
+        functions must be picklable, i.e. defined at module level, to
+        run in a pool.
+        """
+        self.build = build
+        self.grid = grid
+        self.kpis = kpis
+        self.profiles = profiles or {}
+        self.steps = steps
+        self.processes = processes or os.cpu_count()
+        self.results = []
+
+    def points(self):
+        """ Returns a list of all sweep points, each a dictionary of
+        parameter names and values.
+        """
+        names = list(self.grid.keys())
+        return [ dict(zip(names, values)) for values in itertools.product(*self.grid.values()) ]
+
+    def run(self):
+        """ Runs all sweep points and returns the results as a tidy
+        table: a list with one dictionary per point, holding its
+        parameters followed by its KPIs. The table is also kept in
+        self.results.
+        """
+        points = self.points()
+        if self.processes == 1:
+            _init_worker(self.build, self.kpis, self.steps, {})
+            _worker['profiles'] = { name: np.asarray(p, dtype=np.float64) for name, p in self.profiles.items() }
+            self.results = [ _evaluate(point) for point in points ]
+            return self.results
+        blocks = []
+        try:
+            shared = {}
+            for name, profile in self.profiles.items():
+                profile = np.asarray(profile, dtype=np.float64)
+                block = shared_memory.SharedMemory(create=True, size=max(profile.nbytes, 1))
+                blocks.append(block)
+                np.ndarray(profile.shape, dtype=np.float64, buffer=block.buf)[...] = profile
+                shared[name] = (block.name, profile.shape)
+            chunksize = max(1, len(points)//(4*self.processes))
+            with ProcessPoolExecutor( self.processes
+                                    , initializer=_init_worker
+                                    , initargs=(self.build, self.kpis, self.steps, shared) ) as pool:
+                self.results = list(pool.map(_evaluate, points, chunksize=chunksize))
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+        return self.results
+
+    def column(self, name):
+        """ Returns one column of the result table as a numpy array.
+        """
+        return np.array([ row[name] for row in self.results ])
+
+
+# State of a sweep worker process, set up once by _init_worker.
+_worker = {}
+
+def _init_worker(build, kpis, steps, shared):
+    """ Pool initializer. Stores the sweep setup and attaches the shared
+    profiles as read-only numpy arrays.
+    """
+    _worker['build'] = build
+    _worker['kpis'] = kpis
+    _worker['steps'] = steps
+    _worker['blocks'] = []
+    _worker['profiles'] = {}
+    for name, (blockname, shape) in shared.items():
+        block = shared_memory.SharedMemory(name=blockname)
+        _worker['blocks'].append(block)
+        profile = np.ndarray(shape, dtype=np.float64, buffer=block.buf)
+        profile.flags.writeable = False
+        _worker['profiles'][name] = profile
+
+def _evaluate(point):
+    """ Builds, runs and evaluates one sweep point.
+    """
+    s = _worker['build'](**point, **_worker['profiles'])
+    if _worker['steps'] is not None:
+        s.run(_worker['steps'])
+    row = dict(point)
+    for name, kpi in _worker['kpis'].items():
+        row[name] = kpi(s)
+    return row
@@ -1,5 +1,8 @@
 import matplotlib.pyplot as plt
+import numpy as np
 import energyoptinator as eo
+import metrics
+import montecarlo
 import svenska_schabloner as se
 
 
@@ -30,24 +33,40 @@ def test2():
     for _, grid in s.grids.items():
         grid.plot()
 
-def offgrid_house_sim():
+def offgrid_house_profiles():
+    """ Returns the irradiance, hot water and space heating profiles of
+    the off-grid house.
+    """
     tvv = 20*150
     hushel = 6000
     # 150 m² vila
     varme = 18000-tvv-hushel
     # 100 m² villa
     #varme = 12000-tvv-hushel
-    hushel = hushel/87600
     irradiance = [ 13, 24, 41, 90, 114, 108, 102, 105, 88, 90, 53, 16, 13 ] # kWh/m^2, month
-    irr = se.hourly_to_6min(se.daily_to_hourly(se.monthly_to_daily(irradiance)))
+    return { 'irr': se.resample(irradiance, 'month', se.SIX_MINUTES)
+           , 'hotwater': se.hemsol_profile('tvv', tvv)
+           , 'spaceheating': se.hemsol_profile('varme', varme)
+           }
+
+def offgrid_house(irr=None, hotwater=None, spaceheating=None):
+    """ Builds the off-grid house, see offgrid_house_sim(), with the
+    profiles of offgrid_house_profiles() unless others are given. Also
+    used by benchmark.py.
+    """
+    profiles = offgrid_house_profiles()
+    irr = profiles['irr'] if irr is None else irr
+    hotwater = profiles['hotwater'] if hotwater is None else hotwater
+    spaceheating = profiles['spaceheating'] if spaceheating is None else spaceheating
+    hushel = 6000/87600
     s = eo.Simulation('The off-grid house')
     eo.Grid('Electricity', s)
     eo.Grid('Heat', s)
     eo.Grid('Gasoline', s)
     eo.Grid('Wood pellets', s)
     eo.SimpleSink('Household electricity', s, 'Electricity', hushel)
-    eo.TimevariantSink('Hot water', s, 'Heat', se.hourly_to_6min(se.daily_to_hourly(se.monthly_to_daily(se.hemsol_tvv(tvv)))))
-    eo.TimevariantSink('Space heating', s, 'Heat', se.hourly_to_6min(se.daily_to_hourly(se.monthly_to_daily(se.hemsol_varme(varme)))))
+    eo.TimevariantSink('Hot water', s, 'Heat', hotwater)
+    eo.TimevariantSink('Space heating', s, 'Heat', spaceheating)
     eo.Battery('Battery', s, 'Electricity', 20, 15, 0.03/30/24/10)
     eo.SimpleStorage('Accumulator', s, 'Heat', 50, 25)
     eo.SimpleSolar('Solar', s, 'Electricity', irr, 0.18, 60)
@@ -67,36 +86,91 @@ def offgrid_house_sim():
     solheatreg = eo.OnoffRegulator(0.89, 0.9, 0, 1)
     #solheatsig = s.storages['Battery'].soc
     #eo.SimpleBoiler('Electric boiler', s, 'Electricity', 'Heat', solheatreg, solheatsig, 0.1, 0.1)
-    for _ in range(87600):
-        s.step()
+    return s
+
+def offgrid_house_sim():
+    s = metrics.track(offgrid_house())
+    s.run(87600)
+    kpis = metrics.kpis(s)
     #s.plot_storages()
     #s.plot_all()
     totalelec = s.grids['Electricity'].powers['Electricity']
     totalheat = s.grids['Heat'].powers['Heat']
-    heatfactor = [ e/(h+0.0000000000000001) for e, h in zip(totalelec, totalheat) ]
+    heatfactor = totalelec/(totalheat+0.0000000000000001)
     
     fig = plt.figure()
     plt.plot(totalheat, label='Heat')
     plt.plot(totalelec, label='Electricity')
-    plt.plot(heatfactor, label=f"Heat factor necessary, max: {max(heatfactor)*100:2.1f}%")
+    plt.plot(heatfactor, label=f"Heat factor necessary, max: {np.max(heatfactor)*100:2.1f}%")
     plt.legend()
     plt.show()
 
-    print(f"Start/stop for Generator: {len([ 1 for i in range(len(elreg.states)-2) if [elreg.states[i], elreg.states[i+1]] == [0, 1] ])}")
-    print(f"Generator running time: {sum(elreg.states)/10}")
-    print(f"Start/stop for Furnace: {len([ 1 for i in range(len(heatreg.states)-2) if [heatreg.states[i], heatreg.states[i+1]] == [0, 1] ])}")
-    print(f"Furnace running time: {sum(heatreg.states)/10}")
+    gasoline = kpis['energy/Gasoline/Gasoline']
+    pellets = kpis['energy/Wood pellets/Wood pellets']
+    solar = kpis['energy/Electricity/Solar']
+    household = -kpis['energy/Electricity/Household electricity']
+    spaceheating = -kpis['energy/Heat/Space heating']
+    hotwater = -kpis['energy/Heat/Hot water']
+    print(f"Start/stop for Generator: {kpis['starts/Generator']}")
+    print(f"Generator running time: {kpis['run_hours/Generator']:.1f}")
+    print(f"Start/stop for Furnace: {kpis['starts/Furnace']}")
+    print(f"Furnace running time: {kpis['run_hours/Furnace']:.1f}")
     print()
-    print(f"Generator fuel use: {sum(s.grids['Gasoline'].powers['Gasoline'])/1000:2.1f} MWh")
-    print(f"Furnace fuel use: {sum(s.grids['Wood pellets'].powers['Wood pellets'])/1000:2.1f} MWh")
-    print(f"Total solar provided: {sum(s.grids['Electricity'].powers['Solar'])/1000:2.1f} MWh")
-    print(f"Total added energy: {(sum(s.grids['Gasoline'].powers['Gasoline']) + sum(s.grids['Wood pellets'].powers['Wood pellets']) + sum(s.grids['Electricity'].powers['Solar']))/1000:2.1f} MWh")
+    print(f"Generator fuel use: {gasoline/1000:2.1f} MWh")
+    print(f"Furnace fuel use: {pellets/1000:2.1f} MWh")
+    print(f"Total solar provided: {solar/1000:2.1f} MWh")
+    print(f"Total added energy: {(gasoline + pellets + solar)/1000:2.1f} MWh")
     print()
-    print(f"Household electricity: {-sum(s.grids['Electricity'].powers['Household electricity'])/1000:2.1f} MWh")
-    print(f"Space heating: {-sum(s.grids['Heat'].powers['Space heating'])/1000:2.1f} MWh")
-    print(f"Hot water: {-sum(s.grids['Heat'].powers['Hot water'])/1000:2.1f} MWh")
-    print(f"Total energy demand: {-(sum(s.grids['Electricity'].powers['Household electricity']) + sum(s.grids['Heat'].powers['Space heating']) + sum(s.grids['Heat'].powers['Hot water']))/1000:2.1f} MWh")
-    print(f"Primary energy number according to BBR-29: {(sum(s.grids['Gasoline'].powers['Gasoline']) + sum(s.grids['Wood pellets'].powers['Wood pellets']))*0.6/150:3.1f} kWh/m², y")
+    print(f"Household electricity: {household/1000:2.1f} MWh")
+    print(f"Space heating: {spaceheating/1000:2.1f} MWh")
+    print(f"Hot water: {hotwater/1000:2.1f} MWh")
+    print(f"Total energy demand: {(household + spaceheating + hotwater)/1000:2.1f} MWh")
+    print(f"Primary energy number according to BBR-29: {metrics.primary_energy_number(s, ['Gasoline', 'Wood pellets'], 150):3.1f} kWh/m², y")
+
+def offgrid_house_bound(steps=8760):
+    """ Compares the fuel use of the off-grid house's regulators to the
+    least possible, found by Simulation.run_optimal().
+    """
+    s = metrics.track(offgrid_house())
+    s.run(steps)
+    regulated = metrics.kpis(s)
+    s = metrics.track(offgrid_house())
+    s.run_optimal(steps)
+    optimal = metrics.kpis(s)
+    for name in ['energy/Gasoline/Generator', 'energy/Wood pellets/Furnace']:
+        print(f"{name}: {regulated[name]:.0f} kWh regulated, {optimal[name]:.0f} kWh at best")
+
+def offgrid_house_traces(rng, n):
+    """ Randomized weather years for the off-grid house: irradiance
+    resampled a week at a time from nearby dates and scaled by daily
+    weather, with space heating going up on dark days.
+    """
+    profiles = offgrid_house_profiles()
+    days = -(-len(profiles['irr']) // 240)
+    weather = montecarlo.daily_factors(rng, days, n, sigma=0.5)
+    irr = montecarlo.resample_days(profiles['irr'], rng, n)
+    return { 'irr': montecarlo.perturb(irr, weather)
+           , 'spaceheating': montecarlo.perturb(profiles['spaceheating'], weather**-0.3)
+           }
+
+def offgrid_house_montecarlo(scenarios=200):
+    """ Percentiles of the generator's fuel use and starts and of the
+    unmet demand of the off-grid house over randomized weather years.
+    """
+    mc = montecarlo.MonteCarlo( offgrid_house
+                              , offgrid_house_traces
+                              , { 'gasoline': 'energy/Gasoline/Generator'
+                                , 'generator starts': 'starts/Generator'
+                                , 'unmet electricity': 'unmet/Electricity'
+                                , 'unmet heat': 'unmet/Heat' }
+                              , 87600
+                              , scenarios=scenarios
+                              , batch=50 )
+    for summary in mc.batches():
+        print(f"{summary['scenarios']} scenarios")
+        for name, stats in summary.items():
+            if name != 'scenarios':
+                print(f"  {name}: " + ", ".join(f"{p}: {value:.1f}" for p, value in stats.items()))
     
 if __name__ == '__main__':
     offgrid_house_sim()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+import asyncio
+import json
+import os
+import time
+
+## DIGITAL TWIN
+#
+# Runs a simulation in real time as the controller of a real site. Live
+# measurements, like the household load or the solar power, arrive as
+# dictionaries of values, one per time step, and are fed to
+# TimevariantSource and TimevariantSink entities through LiveProfile
+# objects. Every measurement steps the model once, with only the last
+# few steps kept in memory, and the regulator decisions and storage
+# states of charge are published to subscribers.
+#
+# Measurements come from an async iterator: an asyncio.Queue through
+# queue_source(), newline-delimited JSON on a unix socket through
+# unix_socket() or from a named pipe through named_pipe().
+
+class LiveProfile:
+    def __init__(self, initial=0.0, keep=16):
+        """ A time-variant input fed one value per time step, to be
+        given as the supply or drain of a TimevariantSource or
+        TimevariantSink. Only the last keep values are held. initial
+        is used until the first measurement arrives.
+        """
+        self.start = 0
+        self.values = []
+        self.last = initial
+        self.keep = keep
+
+    def push(self, value=None):
+        """ Adds the value of the next time step, repeating the last one
+        if value is None, e.g. when a meter didn't report in time.
+        """
+        if value is not None:
+            self.last = float(value)
+        self.values.append(self.last)
+        if len(self.values) > self.keep:
+            del self.values[0]
+            self.start += 1
+
+    def __len__(self):
+        return self.start + len(self.values)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, _ = index.indices(len(self))
+            if start < self.start:
+                raise IndexError(f"time step {start} is no longer held")
+            return self.values[start-self.start:stop-self.start]
+        if index < self.start:
+            raise IndexError(f"time step {index} is no longer held")
+        return self.values[index-self.start]
+
+
+class DigitalTwin:
+    def __init__(self, sim, profiles, window=1, backlog=64):
+        """ Creates a digital twin of sim. profiles is a dictionary of
+        measurement names and the LiveProfile objects the measurements
+        are pushed to. Only the last window time steps of every series
+        are kept, see Simulation.stream().
+
+        At most backlog measurements wait to be simulated; feed() waits
+        when the backlog is full, so a fast producer is slowed down to
+        the pace of the model instead of filling memory.
+        """
+        self.sim = sim
+        self.profiles = profiles
+        self.window = window
+        self.measurements = asyncio.Queue(backlog)
+        self.subscribers = []
+        self.latency = 0
+        self.max_latency = 0
+        self.dropped = 0
+
+    async def feed(self, measurement):
+        """ Queues a measurement, a dictionary of measurement names and
+        values, waiting while the backlog is full. None stops run().
+        """
+        await self.measurements.put(measurement)
+
+    def subscribe(self, backlog=64):
+        """ Returns an asyncio.Queue receiving the state() after every
+        time step. A subscriber falling more than backlog states behind
+        loses the oldest ones, so it never holds up the controller;
+        they are counted in self.dropped.
+        """
+        queue = asyncio.Queue(backlog)
+        self.subscribers.append(queue)
+        return queue
+
+    def tick(self, measurement):
+        """ Simulates one time step with measurement, publishes the new
+        state and returns it. Measurements missing from measurement
+        keep their last value.
+        """
+        start = time.perf_counter()
+        for name, profile in self.profiles.items():
+            profile.push(measurement.get(name))
+        self.sim.stream(1, chunk=1, window=self.window)
+        state = self.state()
+        self.latency = time.perf_counter() - start
+        self.max_latency = max(self.max_latency, self.latency)
+        for queue in self.subscribers:
+            if queue.full():
+                queue.get_nowait()
+                self.dropped += 1
+            queue.put_nowait(state)
+        return state
+
+    def state(self):
+        """ Returns the current time step, the state of every regulator,
+        keyed by its entity, and the state of charge of every storage.
+        """
+        sim = self.sim
+        return { 'step': sim.steps()
+               , 'regulators': { name: int(entity.regulator.states[-1])
+                                 for name, entity in sim.entities.items()
+                                 if getattr(entity, 'regulator', None) is not None }
+               , 'soc': { name: float(storage.soc()) for name, storage in sim.storages.items() }
+               }
+
+    async def run(self, source=None):
+        """ Simulates measurements as they arrive from source, an async
+        iterator, or from feed() if source is None, until the source
+        ends or feed() gets None. Returns the number of steps simulated.
+        """
+        if source is None:
+            source = queue_source(self.measurements)
+        steps = 0
+        async for measurement in source:
+            self.tick(measurement)
+            steps += 1
+            # Let producers and subscribers run between steps
+            await asyncio.sleep(0)
+        return steps
+
+
+async def queue_source(queue):
+    """ Yields measurements from an asyncio.Queue until it gets None.
+    """
+    while True:
+        measurement = await queue.get()
+        if measurement is None:
+            return
+        yield measurement
+
+async def lines(reader):
+    """ Yields a measurement per line of newline-delimited JSON read
+    from an asyncio.StreamReader, until end of file.
+    """
+    async for line in reader:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+async def unix_socket(path, backlog=64):
+    """ Serves a unix socket at path and yields the measurements every
+    client sends, as newline-delimited JSON, in arrival order. Clients
+    are slowed down when backlog measurements are waiting. Runs until
+    cancelled, or until a client sends null.
+    """
+    queue = asyncio.Queue(backlog)
+    async def client(reader, writer):
+        try:
+            async for measurement in lines(reader):
+                await queue.put(measurement)
+        finally:
+            writer.close()
+    server = await asyncio.start_unix_server(client, path)
+    try:
+        async for measurement in queue_source(queue):
+            yield measurement
+    finally:
+        server.close()
+        await server.wait_closed()
+        if os.path.exists(path):
+            os.remove(path)
+
+async def named_pipe(path, poll=0.05):
+    """ Yields the measurements written to the named pipe (FIFO) at
+    path, as newline-delimited JSON, until the writer closes it. Waits
+    for a writer, checking every poll seconds, without blocking the
+    event loop, so it can be cancelled at any time.
+    """
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    # A blocking open() would wait for a writer in a thread that can't
+    # be cancelled. Opened non-blocking, the FIFO reads end of file
+    # until a writer has opened it, and then data or EAGAIN.
+    fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    try:
+        while True:
+            try:
+                data = os.read(fd, 65536)
+            except BlockingIOError:
+                break
+            if data:
+                reader.feed_data(data)
+                break
+            await asyncio.sleep(poll)
+    except BaseException:
+        os.close(fd)
+        raise
+    with os.fdopen(fd, 'rb', buffering=0) as pipe:
+        transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+        try:
+            async for measurement in lines(reader):
+                yield measurement
+        finally:
+            transport.close()